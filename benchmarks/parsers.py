@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+""" Compare BeautifulSoup parser backends on a saved corpus of Saylor chapter pages
+
+    Usage: python benchmarks/parsers.py path/to/corpus [--parsers html.parser lxml] [--repeat 3] [--serialization prettify]
+
+    The corpus is a directory of chapter .html files saved from saylordotorg.github.io
+    (e.g. with `wget -r -l1 -A html https://saylordotorg.github.io/text_financial-accounting/`).
+    Each page is parsed, run through the chef's page transform (parse_page_links, the same
+    DOMRewriter pass a real run uses), and serialized, and the output is compared against
+    html.parser's. Nothing is downloaded: assets are read from the corpus when they were
+    saved with it and replaced with empty files otherwise.
+
+    Exits with status 1 if any parser's output differs from html.parser's, so it can be
+    used as a check before switching a run to --parser lxml.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from bs4 import BeautifulSoup, FeatureNotFound
+import sushichef
+from utils import minify
+from utils.html import HTMLWriter
+
+
+class OfflineAssets():
+    """ Stands in for the chef's asset and media stores, serving files from the corpus """
+
+    def __init__(self, corpus, directory):
+        self.files = {}
+        for dirpath, dirs, filenames in os.walk(corpus):
+            for filename in filenames:
+                self.files.setdefault(filename, os.path.join(dirpath, filename))
+        self.placeholder = os.path.join(directory, "placeholder")
+        open(self.placeholder, 'wb').close()
+
+    def fetch(self, url, *args, **kwargs):
+        return self.files.get(os.path.basename(url.split("?")[0]), self.placeholder)
+
+    def lookup(self, url):
+        return self.fetch(url)
+
+    def read(self, url):
+        with open(self.fetch(url), 'rb') as fobj:
+            return fobj.read()
+
+
+def transform(markup, parser, zipper, serialization):
+    """ Run the page transform without the network, timing each stage """
+    sushichef.HTML_PARSER = parser
+    timings = {}
+    start = time.perf_counter()
+    soup = BeautifulSoup(markup, parser)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sushichef.parse_page_links("https://saylordotorg.github.io/corpus/", soup, zipper, endpoint="page.html", shared_files=set())
+    timings['transform'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = minify.serialize(soup, serialization)
+    timings['serialize'] = time.perf_counter() - start
+    return output, timings
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument('corpus', help='directory of saved chapter .html files')
+    arg_parser.add_argument('--parsers', nargs='+', default=sushichef.HTML_PARSERS, help='parsers to compare')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='number of times to transform each page')
+    arg_parser.add_argument('--serialization', choices=minify.SERIALIZATION_MODES, default=sushichef.SERIALIZATION,
+        help='how to write the transformed pages')
+    args = arg_parser.parse_args()
+
+    pages = []
+    for dirpath, dirs, filenames in os.walk(args.corpus):
+        for filename in sorted(filenames):
+            if filename.endswith('.html'):
+                with open(os.path.join(dirpath, filename), 'rb') as fobj:
+                    pages.append((filename, fobj.read()))
+    if not pages:
+        sys.exit("No .html files found in {}".format(args.corpus))
+
+    # Point everything the transform writes or downloads at a scratch directory and the corpus
+    directory = tempfile.mkdtemp(prefix="saylor-parsers-")
+    assets = OfflineAssets(args.corpus, directory)
+    sushichef.ASSET_STORE = sushichef.MEDIA_STORE = assets
+    sushichef.SHARED_DIRECTORY = directory
+    sushichef.read_source = lambda base, endpoint=None, **kwargs: assets.read(sushichef.get_source_url(base, endpoint))
+    sushichef.get_video_bin = lambda src: src
+    sushichef.VIDEO_CACHE.get = lambda src: None
+
+    differences = 0
+    try:
+        with HTMLWriter(os.path.join(directory, "pages.zip")) as zipper:
+            # html.parser is what the chef has always used, so it's the reference output
+            reference = {filename: transform(markup, "html.parser", zipper, args.serialization)[0] for filename, markup in pages}
+
+            print("{} pages, {} repeats, {} output".format(len(pages), args.repeat, args.serialization))
+            print("{:<12} {:>10} {:>10} {:>10} {:>10} {:>10}".format("parser", "parse", "transform", "serialize", "total", "identical"))
+            for parser in args.parsers:
+                try:
+                    BeautifulSoup("", parser)
+                except FeatureNotFound:
+                    print("{:<12} not installed".format(parser))
+                    continue
+
+                totals = {'parse': 0.0, 'transform': 0.0, 'serialize': 0.0}
+                different = []
+                for filename, markup in pages:
+                    for _ in range(args.repeat):
+                        output, timings = transform(markup, parser, zipper, args.serialization)
+                        for stage, seconds in timings.items():
+                            totals[stage] += seconds
+                    if output != reference[filename]:
+                        different.append(filename)
+
+                print("{:<12} {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>9.3f}s {:>5}/{:<4}".format(
+                    parser, totals['parse'], totals['transform'], totals['serialize'], sum(totals.values()),
+                    len(pages) - len(different), len(pages)))
+                for filename in different:
+                    print("    differs from html.parser: {}".format(filename))
+                differences += len(different)
+            zipper.write_index_contents("<html></html>") # Only so the zip closes cleanly
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if differences:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+""" Record Saylor books once, then run the chef against a local copy of the site
+
+    Usage:
+        python benchmarks/replay.py record path/to/snapshot [--max-books 3 | --book URL ...]
+        python benchmarks/replay.py serve path/to/snapshot [--port 8000] [--latency 50] [--failure-rate 0.01]
+        python benchmarks/replay.py run path/to/snapshot [--latency 50] [--failure-rate 0.01] [--runs 3] [-- chef options]
+
+    record runs the chef against the live site and saves everything it downloads (table
+    of contents, chapters, images, stylesheets, rendered video iframes, videos) into the
+    snapshot directory. serve serves the snapshot over http, adding latency and failing a
+    fraction of requests with 503s. run starts the server, builds the recorded books from
+    it in a fresh working directory, and reports wall time, throughput, and peak memory,
+    so performance changes can be compared on identical input without a network.
+
+    Chef options after -- (e.g. -- --chapter-workers 8 --serialization minified) are
+    passed to the build, e.g. to compare settings on the same snapshot.
+"""
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIRECTORY)
+
+
+class Snapshot():
+    """
+        Responses recorded from the live site, stored once by content hash
+
+        index.json maps each url to its raw response and/or the body the headless
+        browser rendered for it, and meta.json records which books were scraped.
+    """
+
+    def __init__(self, directory):
+        """ Args: directory: (str) where snapshot is stored """
+        self.directory = directory
+        self.body_directory = os.path.join(directory, "bodies")
+        self.index_path = os.path.join(directory, "index.json")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.lock = threading.Lock()
+        self.index = {}             # Maps urls to {"raw": body name, "rendered": body name}
+        self.meta = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as fobj:
+                self.index = json.load(fobj)
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path) as fobj:
+                self.meta = json.load(fobj)
+
+    def _add(self, url, kind, digest, temppath):
+        bodypath = os.path.join(self.body_directory, digest)
+        with self.lock:
+            if os.path.isfile(bodypath):
+                os.remove(temppath)
+            else:
+                os.replace(temppath, bodypath)
+            self.index.setdefault(url, {})[kind] = digest
+
+    def _open_temp(self):
+        os.makedirs(self.body_directory, exist_ok=True)
+        return tempfile.mkstemp(dir=self.body_directory, suffix=".tmp")
+
+    """ RECORDER METHODS (see downloader.RECORDER) """
+
+    def record(self, url, content, rendered=False, headers=None):
+        if urlparse(url).scheme not in ("http", "https"):
+            return
+        content = content.encode("utf-8") if isinstance(content, str) else content
+        fd, temppath = self._open_temp()
+        with os.fdopen(fd, "wb") as fobj:
+            fobj.write(content)
+        self._add(url, "rendered" if rendered else "raw", hashlib.sha256(content).hexdigest(), temppath)
+
+    def record_stream(self, url, chunks):
+        # Saved once the download has been read to the end, so partial downloads are never recorded
+        hasher = hashlib.sha256()
+        fd, temppath = self._open_temp()
+        try:
+            with os.fdopen(fd, "wb") as fobj:
+                for chunk in chunks:
+                    fobj.write(chunk)
+                    hasher.update(chunk)
+                    yield chunk
+        except BaseException:
+            os.remove(temppath)
+            raise
+        self._add(url, "raw", hasher.hexdigest(), temppath)
+
+    """ USER-FACING METHODS """
+
+    def lookup(self, url, rendered=False):
+        """ lookup: Gets path to recorded body for url
+            Args:
+                url: (str) url that was recorded
+                rendered: (boolean) prefer the body rendered by the browser (optional)
+            Returns: (str path, boolean whether body is rendered) or (None, False) if url wasn't recorded
+        """
+        entry = self.index.get(url, {})
+        kind = "rendered" if rendered and "rendered" in entry else "raw" if "raw" in entry else "rendered" if "rendered" in entry else None
+        if not kind:
+            return None, False
+        return os.path.join(self.body_directory, entry[kind]), kind == "rendered"
+
+    def save(self, **meta):
+        """ save: Writes index and metadata (e.g. books=..., max_books=...) to the snapshot directory
+            Returns: None
+        """
+        self.meta.update(meta)
+        with self.lock:
+            for path, data in ((self.index_path, self.index), (self.meta_path, self.meta)):
+                with open(path + ".tmp", "w") as fobj:
+                    json.dump(data, fobj, indent=2, sort_keys=True)
+                os.replace(path + ".tmp", path)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+        Serves a snapshot at http://host:port/<scheme>/<host>/<path> (see downloader.get_download_url),
+        adding latency and failing some requests like the live site would
+    """
+    daemon_threads = True
+
+    def __init__(self, snapshot, port=0, latency=0, jitter=0, failure_rate=0.0, seed=0):
+        """ Args:
+                snapshot: (Snapshot) responses to serve
+                port: (int) port to listen on (0 picks a free port)
+                latency: (int) milliseconds to wait before responding
+                jitter: (int) up to this many more milliseconds to wait, picked at random
+                failure_rate: (float) fraction of requests to answer with 503
+                seed: (int) seed for picking jitter and failures, so runs see the same pattern
+        """
+        super(ReplayServer, self).__init__(("127.0.0.1", port), ReplayHandler)
+        self.snapshot = snapshot
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "failures": 0, "missing": 0}
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def count(self, **counts):
+        with self.lock:
+            for field, value in counts.items():
+                self.stats[field] += value
+
+    def pick(self):
+        """ Pick delay in seconds and whether to fail the next request """
+        with self.lock:
+            delay = (self.latency + self.random.uniform(0, self.jitter)) / 1000.0
+            return delay, self.random.random() < self.failure_rate
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass # Thousands of requests per run, so only errors are interesting
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, head=False):
+        delay, fail = self.server.pick()
+        time.sleep(delay)
+        self.server.count(requests=1)
+        if fail:
+            self.server.count(failures=1)
+            self.send_error(503, "Injected failure")
+            return
+
+        # Path is /<scheme>/<host>/<path>
+        scheme, _, rest = self.path.lstrip("/").partition("/")
+        url = "{}://{}".format(scheme, rest)
+        bodypath, rendered = self.server.snapshot.lookup(url, rendered="HeadlessChrome" in self.headers.get("User-Agent", ""))
+        if not bodypath:
+            self.server.count(missing=1)
+            self.send_error(404, "Not in snapshot: {}".format(url))
+            return
+
+        with open(bodypath, "rb") as fobj:
+            body = fobj.read()
+        if rendered:
+            # Browser reads document.body.innerHTML, so wrap recorded body back up as a page
+            body = b"<html><body>" + body + b"</body></html>"
+        content_type = "text/html" if rendered else mimetypes.guess_type(urlparse(url).path)[0] or "text/html"
+        etag = '"{}"'.format(os.path.basename(bodypath))
+
+        # Support resuming downloads (bytes=N- ranges, which is what the chef asks for)
+        start = 0
+        requested = self.headers.get("Range", "")
+        if requested.startswith("bytes=") and requested.endswith("-") and self.headers.get("If-Range", etag) == etag:
+            start = int(requested[len("bytes="):-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(body)))
+                self.end_headers()
+                return
+
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if start:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(body) - 1, len(body)))
+        self.end_headers()
+        body = body[start:]
+        if not head:
+            self.wfile.write(body)
+            self.server.count(bytes=len(body))
+
+
+def add_chef_arguments(arg_parser):
+    """ Options passed through to the chef (same names as sushichef.py's, left out to use its defaults) """
+    arg_parser.add_argument('--chapter-workers', type=int)
+    arg_parser.add_argument('--book-workers', type=int)
+    arg_parser.add_argument('--parser')
+    arg_parser.add_argument('--serialization')
+    arg_parser.add_argument('--zip-compression-level', type=int)
+
+
+def build(books=None, max_books=None, workdir=None, **options):
+    """ Build channel the way the chef would, without uploading it
+        Args:
+            books: ([str]) book urls to scrape instead of the whole site (optional)
+            max_books: (int) only scrape the first N books on the site (optional)
+            workdir: (str) where to put downloads, zips, and caches instead of the repo (optional)
+        Returns: ChannelNode
+    """
+    import sushichef
+    from ricecooker.classes import nodes
+    from utils import archive, blobstore, checkpoint, mediastore, videocache
+
+    # Start from nothing, so every download the build needs is made (and recorded)
+    if workdir:
+        sushichef.DOWNLOAD_DIRECTORY = os.path.join(workdir, "downloads")
+        sushichef.SHARED_DIRECTORY = os.path.join(workdir, "shared")
+        sushichef.STAGING_DIRECTORY = os.path.join(sushichef.DOWNLOAD_DIRECTORY, ".partial")
+        sushichef.ASSET_STORE = blobstore.BlobStore(os.path.join(workdir, "assets"), max_size=sushichef.ASSET_MAX_SIZE)
+        sushichef.MEDIA_STORE = mediastore.MediaStore(os.path.join(workdir, "media"), max_size=sushichef.MEDIA_MAX_SIZE)
+        sushichef.PAGE_ARCHIVE = archive.PageArchive(os.path.join(sushichef.DOWNLOAD_DIRECTORY, "archive", "pages"),
+            max_size=sushichef.ARCHIVE_MAX_SIZE)
+        sushichef.JOURNAL = checkpoint.Journal(os.path.join(workdir, sushichef.CHECKPOINT_JOURNAL))
+        sushichef.VIDEO_CACHE = videocache.VideoCache(os.path.join(workdir, sushichef.VIDEO_MAP_JSON))
+        options['metrics_report'] = os.path.join(workdir, os.path.basename(sushichef.METRICS_REPORT))
+        for directory in (sushichef.DOWNLOAD_DIRECTORY, sushichef.SHARED_DIRECTORY):
+            os.makedirs(directory, exist_ok=True)
+
+    sushichef.configure(max_books=max_books, **options)
+    channel = nodes.ChannelNode(source_id=sushichef.CHANNEL_SOURCE_ID, source_domain=sushichef.CHANNEL_DOMAIN,
+        title=sushichef.CHANNEL_NAME, language=sushichef.CHANNEL_LANGUAGE)
+    if books:
+        try:
+            for url in books:
+                node = sushichef.scrape_book(url, sushichef.LICENSE)
+                if node:
+                    channel.add_child(node)
+        finally:
+            sushichef.downloader.close_browser()
+            sushichef.write_metrics_report()
+    else:
+        sushichef.scrape_page(channel)
+    return channel
+
+
+def record(args):
+    from utils import downloader
+    snapshot = Snapshot(args.snapshot)
+    downloader.RECORDER = snapshot
+    start = time.time()
+    try:
+        build(books=args.book, max_books=None if args.book else args.max_books, workdir=tempfile.mkdtemp(prefix="saylor-record-"))
+    finally:
+        snapshot.save(books=args.book, max_books=None if args.book else args.max_books)
+    print("Recorded {} urls in {:.1f}s to {}".format(len(snapshot.index), time.time() - start, args.snapshot))
+
+
+def serve(args):
+    server = ReplayServer(Snapshot(args.snapshot), port=args.port, latency=args.latency, jitter=args.jitter,
+        failure_rate=args.failure_rate, seed=args.seed)
+    print("Serving {} urls at {}".format(len(server.snapshot.index), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats))
+
+
+def run(args):
+    snapshot = Snapshot(args.snapshot)
+    if not snapshot.index:
+        sys.exit("No snapshot found in {} (use record first)".format(args.snapshot))
+
+    results = []
+    for run_number in range(args.runs):
+        server = ReplayServer(snapshot, latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, seed=args.seed)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # Each run starts cold in its own directory, with mathjax where the chef expects it
+        workdir = tempfile.mkdtemp(prefix="saylor-replay-")
+        os.symlink(os.path.join(ROOT_DIRECTORY, "mathjax"), os.path.join(workdir, "mathjax"))
+        command = [sys.executable, os.path.realpath(__file__), "build", args.snapshot, "--replay-url", server.url, "--workdir", workdir] + args.chef_args
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT_DIRECTORY, os.environ.get("PYTHONPATH")])))
+        start = time.time()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL if args.quiet else None, stderr=subprocess.STDOUT if args.quiet else None)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_seconds = time.time() - start
+        process.returncode = returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        server.shutdown()
+        server.server_close()
+
+        with open(os.path.join(workdir, "metrics.json")) as fobj:
+            metrics = json.load(fobj)
+        zips = [os.path.join(dirpath, f) for dirpath, _, filenames in os.walk(os.path.join(workdir, "downloads")) for f in filenames if f.endswith(".zip")]
+        pages = metrics["stages"].get("serialize", {}).get("calls", 0)
+        results.append({
+            "run": run_number + 1,
+            "returncode": returncode,
+            "wall_seconds": wall_seconds,
+            "books": len(zips),
+            "pages": pages,
+            "pages_per_second": pages / wall_seconds if wall_seconds else 0,
+            "bytes_served": server.stats["bytes"],
+            "mb_per_second": server.stats["bytes"] / 1024.0 / 1024.0 / wall_seconds if wall_seconds else 0,
+            "zip_bytes": sum(os.path.getsize(path) for path in zips),
+            "requests": server.stats["requests"],
+            "injected_failures": server.stats["failures"],
+            "missing": server.stats["missing"],
+            "peak_rss_mb": usage.ru_maxrss / 1024.0, # Kilobytes on linux (the headless browser isn't included)
+        })
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{:<4} {:>9} {:>6} {:>6} {:>8} {:>8} {:>10} {:>9} {:>8} {:>8}".format(
+        "run", "wall", "books", "pages", "pages/s", "MB/s", "zip MB", "requests", "failed", "rss MB"))
+    for result in results:
+        print("{run:<4} {wall_seconds:>8.1f}s {books:>6} {pages:>6} {pages_per_second:>8.2f} {mb_per_second:>8.2f} {zip_mb:>10.1f} {requests:>9} {injected_failures:>8} {peak_rss_mb:>8.0f}".format(
+            zip_mb=result["zip_bytes"] / 1024.0 / 1024.0, **result))
+        if result["returncode"] or result["missing"]:
+            print("     exit code {returncode}, {missing} requests not in snapshot".format(**result))
+    if args.output:
+        with open(args.output, "w") as fobj:
+            json.dump({"snapshot": args.snapshot, "chef_args": args.chef_args, "latency": args.latency, "jitter": args.jitter,
+                "failure_rate": args.failure_rate, "runs": results}, fobj, indent=2)
+
+
+def build_from_snapshot(args):
+    from utils import downloader
+    snapshot = Snapshot(args.snapshot)
+    downloader.REPLAY_URL = args.replay_url
+    options = {key: value for key, value in vars(args).items() if value is not None and key not in ("command", "snapshot", "replay_url", "workdir", "func")}
+    build(books=snapshot.meta.get("books"), max_books=snapshot.meta.get("max_books"), workdir=args.workdir, **options)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = arg_parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    record_parser = subparsers.add_parser("record", help="save what the chef downloads from the live site")
+    record_parser.add_argument("snapshot", help="directory to save snapshot to")
+    record_parser.add_argument("--max-books", type=int, default=3, help="scrape the first N books on the site")
+    record_parser.add_argument("--book", action="append", help="book url to scrape instead (can be repeated)")
+    record_parser.set_defaults(func=record)
+
+    for name, func, help in (("serve", serve, "serve snapshot over http"), ("run", run, "benchmark the chef against snapshot")):
+        server_parser = subparsers.add_parser(name, help=help)
+        server_parser.add_argument("snapshot", help="directory snapshot was saved to")
+        server_parser.add_argument("--latency", type=int, default=0, help="milliseconds to wait before each response")
+        server_parser.add_argument("--jitter", type=int, default=0, help="up to this many more milliseconds, picked at random")
+        server_parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of requests to fail with 503")
+        server_parser.add_argument("--seed", type=int, default=0, help="seed for jitter and failures")
+        server_parser.set_defaults(func=func)
+        if name == "serve":
+            server_parser.add_argument("--port", type=int, default=8000)
+        else:
+            server_parser.add_argument("--runs", type=int, default=1, help="number of times to build the snapshot")
+            server_parser.add_argument("--output", help="also write results to this json file")
+            server_parser.add_argument("--keep", action="store_true", help="keep each run's working directory")
+            server_parser.add_argument("--quiet", action="store_true", help="hide the chef's logging")
+            server_parser.add_argument("chef_args", nargs=argparse.REMAINDER, help="options for the chef, after --")
+
+    # Runs in a subprocess for each `run`, so memory is measured for the build alone
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("snapshot")
+    build_parser.add_argument("--replay-url", required=True)
+    build_parser.add_argument("--workdir")
+    add_chef_arguments(build_parser)
+    build_parser.set_defaults(func=build_from_snapshot)
+
+    args = arg_parser.parse_args()
+    if getattr(args, "chef_args", None) and args.chef_args[0] == "--":
+        args.chef_args = args.chef_args[1:]
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
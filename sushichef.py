@@ -1,10 +1,18 @@
 #!/usr/bin/env python
+import collections
+import hashlib
 import json
+import logging
+import multiprocessing
 import os
 import requests
 import sys
+import shutil
+import threading
+import time
 sys.path.append(os.getcwd()) # Handle relative imports
-from utils import html, logger, downloader
+from utils import archive, blobstore, checkpoint, html, images, logger, downloader, manifest, mediastore, minify, retry, rewriter, transcode, videocache, webcache
+from utils.metrics import METRICS
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import nodes, files, questions, licenses
 from ricecooker.config import LOGGER
@@ -15,7 +23,7 @@ from le_utils.constants import licenses, exercises, content_kinds, file_formats,
 """ Additional imports """
 ###########################################################
 from requests.exceptions import HTTPError
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound
 from client import Client
 from multiprocessing.pool import ThreadPool
 
@@ -36,24 +44,103 @@ BASE_URL = "https://www.saylor.org/books/"
 COPYRIGHT_HOLDER = "Saylor Academy"
 LICENSE = licenses.CC_BY_NC_SA
 
+# Both are created by configure, so importing the chef (e.g. from benchmarks) doesn't write anything
 DOWNLOAD_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "downloads")
-if not os.path.exists(DOWNLOAD_DIRECTORY):
-    os.makedirs(DOWNLOAD_DIRECTORY)
-
 SHARED_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "shared")
-if not os.path.exists(SHARED_DIRECTORY):
-    os.makedirs(SHARED_DIRECTORY)
 MATHJAX_URL = "mathjax"
 
+# Custom styles and glossary script are written to the shared folder of every zip
+STYLES_FILENAME = "saylor.css"
+GLOSS_SCRIPT_FILENAME = "saylor-gloss.js"
+
+# Downloaded images, stylesheets, scripts, and videos are stored once by content and copied into zips from here
+ASSET_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "assets")
+ASSET_MAX_SIZE = 8192 * webcache.MB         # Pruned down to this at the end of each run (see prune_stores)
+ASSET_STORE = blobstore.BlobStore(ASSET_DIRECTORY, max_size=ASSET_MAX_SIZE)
+
+# Videos are stored by their video bin url, so each one is downloaded once per run however many pages embed it,
+# and interrupted downloads are resumed
+MEDIA_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "media")
+MEDIA_MAX_SIZE = 16384 * webcache.MB
+MEDIA_STORE = mediastore.MediaStore(MEDIA_DIRECTORY, max_size=MEDIA_MAX_SIZE)
+
+# Number of chapter pages to download and parse at the same time (see --chapter-workers)
+CHAPTER_WORKERS = 4
+
+# Number of books to build at the same time (see --book-workers)
+BOOK_WORKERS = 2
+
+# Which part of the pipeline to run (see --step; ricecooker already has a --stage option)
+#   fetch: download pages into PAGE_ARCHIVE and assets into ASSET_STORE, without building zips
+#   transform: build zips from PAGE_ARCHIVE and ASSET_STORE alone, a process per book
+#   all: both at once (pages are still archived, so transform can be rerun later)
+STEPS = ["fetch", "transform", "all"]
+STEP = "all"
+ARCHIVE_MAX_SIZE = 4096 * webcache.MB
+PAGE_ARCHIVE = archive.PageArchive(os.path.join(DOWNLOAD_DIRECTORY, "archive", "pages"), max_size=ARCHIVE_MAX_SIZE)
+TRANSFORM_WORKERS = os.cpu_count() or 1     # Number of books to transform at the same time (see --transform-workers)
+
+# Only rebuild book zips whose sources, assets, or transform code changed (see --incremental)
+INCREMENTAL = False
+ASSET_KINDS = ["files", "shared", "videos"]     # Assets in book manifests: asset store urls, shared file urls, and video bins
+MAX_BOOKS = None        # Stop after this many books, e.g. to record a small snapshot (see --max-books)
+
+# Changes to the chef or its utils can change the generated zips, so they're part of each book's manifest
+UTILS_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "utils")
+TRANSFORM_FILES = [os.path.realpath(__file__)] + sorted(os.path.join(UTILS_DIRECTORY, f) for f in os.listdir(UTILS_DIRECTORY) if f.endswith(".py"))
+
+# BeautifulSoup parser for downloaded pages (see --parser; lxml is faster but must be installed)
+HTML_PARSER = "html.parser"
+HTML_PARSERS = ["html.parser", "lxml"]
+
+# Small snippets (e.g. embedded iframe code) are always parsed with html.parser,
+# since lxml wraps fragments in <html><body>
+FRAGMENT_PARSER = "html.parser"
+
+# Soup used to create new tags for any page (avoids building a throwaway soup per tag)
+TAG_FACTORY = BeautifulSoup("", FRAGMENT_PARSER)
+
+# How to write pages into zips (see --serialization)
+SERIALIZATION = "prettify"
+
+# Deflate level for text files in book zips, 0 stores everything (see --zip-compression-level)
+ZIP_COMPRESSION_LEVEL = 6
+
+# Recompress and downscale images in a process pool before they go in zips (see --optimize-images, needs Pillow)
+OPTIMIZE_IMAGES = False
+MAX_IMAGE_DIMENSION = 1600  # Largest width or height to keep (see --max-image-dimension)
+IMAGE_FORMAT = "keep"       # Format to convert images to (see --image-format)
+IMAGE_WORKERS = os.cpu_count() or 1
+IMAGE_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "optimized") # Cache of optimized images
+IMAGE_CACHE = webcache.BoundedDirectory(IMAGE_DIRECTORY, 2048 * webcache.MB)
+IMAGE_OPTIMIZER = None      # Set up by configure when images are optimized
+
+# Transcode videos with a local ffmpeg before they go in zips (see --transcode-videos)
+TRANSCODE_PRESET = None     # One of transcode.PRESETS, or None to keep the original videos
+TRANSCODE_WORKERS = 2       # Number of videos to transcode at once (see --transcode-workers)
+TRANSCODE_DIRECTORY = "{}{}{}".format(os.path.dirname(os.path.realpath(__file__)), os.path.sep, "transcoded") # Cache of transcoded videos
+TRANSCODE_CACHE = webcache.BoundedDirectory(TRANSCODE_DIRECTORY, 8192 * webcache.MB)
+TRANSCODER = None           # Set up by configure when videos are transcoded
+
+# Stores are pruned to their caps at the end of each run, keeping anything the run used (see prune_stores)
+RUN_STARTED = None
+
+# Finished books and chapters are journaled so an interrupted run can resume (see --fresh)
+CHECKPOINT_JOURNAL = "checkpoint.jsonl"
+JOURNAL = checkpoint.Journal(CHECKPOINT_JOURNAL)
+STAGING_DIRECTORY = os.path.join(DOWNLOAD_DIRECTORY, ".partial") # Finished chapters of unfinished books
+
+# Where to write per-book, per-page, per-stage timings at the end of the run (.json and .csv, see --metrics-report)
+METRICS_REPORT = "metrics"
+METRICS_TOP_N = 10      # Number of slowest books and pages to log
+
+# Assets that failed to download, tried again at the end of the run (maps book urls to asset urls)
+DEFERRED = retry.DeferredQueue()
+BOOK_LICENSES = {}      # Maps book urls to their licenses so books can be rebuilt after deferred retries
+
 # Videos tend to load unreliably, so use json to track links to avoid having to load every time
 VIDEO_MAP_JSON = "videos.json"
-VIDEO_MAPPING = {}
-if not os.path.isfile(VIDEO_MAP_JSON):
-    with open(VIDEO_MAP_JSON, "wb") as videojson:
-        videojson.write(b"{}")
-
-with open(VIDEO_MAP_JSON, "rb") as videojson:
-    VIDEO_MAPPING = json.load(videojson)
+VIDEO_CACHE = videocache.VideoCache(VIDEO_MAP_JSON)
 
 
 """ The chef class that takes care of uploading channel to the content curation server. """
@@ -68,6 +155,43 @@ class MyChef(SushiChef):
         'CHANNEL_DESCRIPTION': CHANNEL_DESCRIPTION,      # Description of the channel (optional)
     }
 
+    def __init__(self, *args, **kwargs):
+        super(MyChef, self).__init__(*args, **kwargs)
+        self.arg_parser.add_argument('--chapter-workers', type=int, default=CHAPTER_WORKERS,
+            help='number of chapter pages to download and parse in parallel per book')
+        self.arg_parser.add_argument('--book-workers', type=int, default=BOOK_WORKERS,
+            help='number of book zips to build in parallel')
+        self.arg_parser.add_argument('--incremental', action='store_true', default=INCREMENTAL,
+            help='reuse book zips whose source pages and transform code are unchanged')
+        self.arg_parser.add_argument('--parser', choices=HTML_PARSERS, default=HTML_PARSER,
+            help='BeautifulSoup parser to use for downloaded pages')
+        self.arg_parser.add_argument('--serialization', choices=minify.SERIALIZATION_MODES, default=SERIALIZATION,
+            help='how to write html pages (minified also minifies the injected css and js)')
+        self.arg_parser.add_argument('--zip-compression-level', type=int, choices=range(10), default=ZIP_COMPRESSION_LEVEL,
+            help='deflate level for html, css, and js in book zips (0 to store uncompressed)')
+        self.arg_parser.add_argument('--fresh', action='store_true',
+            help='ignore books and chapters finished by an interrupted run and start over')
+        self.arg_parser.add_argument('--step', choices=STEPS, default=STEP,
+            help='fetch pages into the archive, transform the archive into zips, or do all at once')
+        self.arg_parser.add_argument('--transform-workers', type=int, default=TRANSFORM_WORKERS,
+            help='number of processes to transform books with when using --step transform')
+        self.arg_parser.add_argument('--optimize-images', action='store_true', default=OPTIMIZE_IMAGES,
+            help='recompress images and shrink ones larger than --max-image-dimension (needs Pillow)')
+        self.arg_parser.add_argument('--max-image-dimension', type=int, default=MAX_IMAGE_DIMENSION,
+            help='largest image width or height to keep when optimizing images (0 keeps every size)')
+        self.arg_parser.add_argument('--image-format', choices=images.IMAGE_FORMATS, default=IMAGE_FORMAT,
+            help='format to convert images to when optimizing images')
+        self.arg_parser.add_argument('--image-workers', type=int, default=IMAGE_WORKERS,
+            help='number of processes to optimize images with')
+        self.arg_parser.add_argument('--transcode-videos', choices=sorted(transcode.PRESETS), default=TRANSCODE_PRESET,
+            help='transcode videos to this size with ffmpeg (keeps original videos if not given)')
+        self.arg_parser.add_argument('--transcode-workers', type=int, default=TRANSCODE_WORKERS,
+            help='number of videos to transcode at once')
+        self.arg_parser.add_argument('--max-books', type=int, default=MAX_BOOKS,
+            help='only scrape the first N books listed on the site')
+        self.arg_parser.add_argument('--metrics-report', default=METRICS_REPORT,
+            help='where to write timings for each book, page, and stage (.json and .csv are added)')
+
 
     """ Main scraping method """
     ###########################################################
@@ -78,8 +202,14 @@ class MyChef(SushiChef):
         """
         channel = self.get_channel(*args, **kwargs)   # Creates ChannelNode from data in self.channel_info
 
+        configure(**kwargs)
         scrape_page(channel)
 
+        # Nothing to upload until the archive has been transformed
+        if STEP == "fetch":
+            LOGGER.info("Fetched {} pages to {}, run again with --step transform to build zips".format(len(PAGE_ARCHIVE), PAGE_ARCHIVE.data_path))
+            sys.exit(0)
+
         raise_for_invalid_channel(channel)            # Check for errors in channel construction
 
         return channel
@@ -87,61 +217,174 @@ class MyChef(SushiChef):
 
 """ Helper Methods """
 ###########################################################
+def configure(**options):
+    """ Override run settings with any options passed in from the command line """
+    global CHAPTER_WORKERS, BOOK_WORKERS, INCREMENTAL, HTML_PARSER, SERIALIZATION, ZIP_COMPRESSION_LEVEL, METRICS_REPORT, MAX_BOOKS, STEP, TRANSFORM_WORKERS
+    global OPTIMIZE_IMAGES, MAX_IMAGE_DIMENSION, IMAGE_FORMAT, IMAGE_WORKERS, IMAGE_OPTIMIZER
+    global TRANSCODE_PRESET, TRANSCODE_WORKERS, TRANSCODER, RUN_STARTED
+    RUN_STARTED = time.time()
+    CHAPTER_WORKERS = max(1, options.get('chapter_workers') or CHAPTER_WORKERS)
+    BOOK_WORKERS = max(1, options.get('book_workers') or BOOK_WORKERS)
+    INCREMENTAL = options.get('incremental', INCREMENTAL)
+    HTML_PARSER = options.get('parser') or HTML_PARSER
+    SERIALIZATION = options.get('serialization') or SERIALIZATION
+    ZIP_COMPRESSION_LEVEL = options.get('zip_compression_level', ZIP_COMPRESSION_LEVEL)
+    METRICS_REPORT = options.get('metrics_report') or METRICS_REPORT
+    MAX_BOOKS = options.get('max_books') or MAX_BOOKS
+    STEP = options.get('step') or STEP
+    TRANSFORM_WORKERS = max(1, options.get('transform_workers') or TRANSFORM_WORKERS)
+    OPTIMIZE_IMAGES = options.get('optimize_images', OPTIMIZE_IMAGES)
+    MAX_IMAGE_DIMENSION = options.get('max_image_dimension', MAX_IMAGE_DIMENSION)
+    IMAGE_FORMAT = options.get('image_format') or IMAGE_FORMAT
+    IMAGE_WORKERS = max(1, options.get('image_workers') or IMAGE_WORKERS)
+    if OPTIMIZE_IMAGES and not images.ImageOptimizer.is_available():
+        LOGGER.warning("Pillow is not installed, so images won't be optimized (pip install Pillow)")
+        OPTIMIZE_IMAGES = False
+    if OPTIMIZE_IMAGES:
+        IMAGE_OPTIMIZER = images.ImageOptimizer(IMAGE_DIRECTORY, max_dimension=MAX_IMAGE_DIMENSION, image_format=IMAGE_FORMAT, workers=IMAGE_WORKERS)
+    TRANSCODE_PRESET = options.get('transcode_videos') or TRANSCODE_PRESET
+    TRANSCODE_WORKERS = max(1, options.get('transcode_workers') or TRANSCODE_WORKERS)
+    if TRANSCODE_PRESET and not transcode.find_ffmpeg():
+        LOGGER.warning("ffmpeg is not installed, so videos won't be transcoded")
+        TRANSCODE_PRESET = None
+    if TRANSCODE_PRESET:
+        TRANSCODER = transcode.VideoTranscoder(TRANSCODE_DIRECTORY, TRANSCODE_PRESET, workers=TRANSCODE_WORKERS)
+    if STEP == "transform":
+        downloader.ARCHIVE = PAGE_ARCHIVE
+    elif downloader.RECORDER is None: # An empty archive is falsy, so check for None
+        downloader.RECORDER = PAGE_ARCHIVE
+    for directory in (DOWNLOAD_DIRECTORY, SHARED_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+    if options.get('fresh'):
+        clear_checkpoints()
+    try:
+        BeautifulSoup("", HTML_PARSER)
+    except FeatureNotFound:
+        LOGGER.warning("Parser {} is not installed, falling back to {}".format(HTML_PARSER, FRAGMENT_PARSER))
+        HTML_PARSER = FRAGMENT_PARSER
+    if HTML_PARSER != FRAGMENT_PARSER:
+        LOGGER.warning("Parser {} can repair malformed pages differently than {} (check with benchmarks/parsers.py)".format(HTML_PARSER, FRAGMENT_PARSER))
+
+def get_transform_settings():
+    """ Run settings that affect the contents of generated zips """
+    return {
+        "parser": HTML_PARSER, "serialization": SERIALIZATION, "zip_compression_level": ZIP_COMPRESSION_LEVEL,
+        "images": OPTIMIZE_IMAGES and {"max_dimension": MAX_IMAGE_DIMENSION, "format": IMAGE_FORMAT},
+        "videos": TRANSCODE_PRESET,
+    }
+
+def get_transform_hash():
+    """ Hash code and settings that affect the contents of generated zips """
+    hasher = hashlib.sha256()
+    for path in TRANSFORM_FILES:
+        with open(path, 'rb') as fobj:
+            hasher.update(fobj.read())
+    hasher.update(json.dumps(get_transform_settings(), sort_keys=True).encode())
+    return hasher.hexdigest()
+
 def generate_id(text):
     """ Generate source_id based on text """
     return "".join(c for c in text.lower().replace(' ', '-') if c.isalnum() or c == '-')[:200]
 
-def read_source(base, endpoint=None, loadjs=False):
-    """ Read url """
+def get_source_url(base, endpoint=None):
+    """ Resolve url for endpoint relative to base """
     if base.count('http://') > 1: # Special case: http://web.archive.org/web/.../http://2012books.lardbucket.org/books/...
-        return downloader.read("http://{}".format(base.split('http://')[-1]), loadjs=loadjs)
+        return "http://{}".format(base.split('http://')[-1])
     elif not endpoint:
-        return downloader.read(base, loadjs=loadjs)
+        return base
     elif endpoint.startswith('http'):
-        return downloader.read(endpoint, loadjs=loadjs)
+        return endpoint
     elif endpoint.startswith('/'):
-        return downloader.read(os.path.dirname(base) + endpoint.lstrip('/'), loadjs=loadjs)
+        return os.path.dirname(base) + endpoint.lstrip('/')
     else:
-        return downloader.read(os.path.dirname(base).rstrip("/") + "/" + endpoint, loadjs=loadjs)
+        return os.path.dirname(base).rstrip("/") + "/" + endpoint
+
+def read_source(base, endpoint=None, loadjs=False, wait_for=None):
+    """ Read url """
+    return downloader.read(get_source_url(base, endpoint), loadjs=loadjs, wait_for=wait_for)
 
-def write_to_shared_library_or_zip(main_url, zipper, endpoint=None, directory="files", filename=None):
-    """ Write any shared files to library """
+def make_soup(markup):
+    """ Parse downloaded page with the configured parser """
+    with METRICS.timed("parse"):
+        METRICS.add(bytes=len(markup))
+        return BeautifulSoup(markup, HTML_PARSER)
+
+def new_tag(name, **attrs):
+    """ Create new tag that can be added to any page """
+    return TAG_FACTORY.new_tag(name, **attrs)
+
+def read_soup(base, endpoint=None, loadjs=False, wait_for=None):
+    """ Read and parse url (every call gets its own tree, so callers can rewrite it in place) """
+    return make_soup(read_source(base, endpoint=endpoint, loadjs=loadjs, wait_for=wait_for))
+
+def write_to_shared_library_or_zip(main_url, zipper, endpoint=None, directory="files", filename=None, shared_files=None):
+    """ Write any shared files to library (recording them in shared_files) """
     filename = filename or os.path.basename(endpoint)
 
     # Files shared across pages start with "shared"
     if endpoint and endpoint.startswith("shared"):
         filepath = "{}{}{}".format(SHARED_DIRECTORY, os.path.sep, filename)
         if not os.path.isfile(filepath):
-            with open(filepath, 'wb') as fobj:
-                fobj.write(read_source(main_url, endpoint=endpoint))
+            write_shared_file(get_source_url(main_url, endpoint), filepath)
+        if shared_files is not None:
+            shared_files.add(filepath)
         return "shared/" + filename
     elif endpoint:
-        return zipper.write_url(main_url + endpoint, filename, directory=directory)
+        return zipper.write_file(ASSET_STORE.fetch(main_url + endpoint), filename=filename, directory=directory)
     else:
-        return zipper.write_url(main_url, filename, directory=directory)
+        return zipper.write_file(ASSET_STORE.fetch(main_url), filename=filename, directory=directory)
+
 
+def write_shared_file(url, filepath):
+    """ Download file to shared library """
+    # Write to a temporary file first so other book workers never see a partial file
+    temppath = "{}.{}.tmp".format(filepath, threading.get_ident())
+    with open(temppath, 'wb') as fobj:
+        fobj.write(read_source(url))
+    os.replace(temppath, filepath)
 
-def write_shared_library_to_zip(zipper):
-    """ Write all shared files to the zip """
-    # Automatically write shared files to zip
-    for dirpath,dirs,files in os.walk(SHARED_DIRECTORY):
-        for f in files:
-            zipper.write_file(os.path.join(dirpath, f), directory="shared")
+def write_shared_library_to_zip(zipper, shared_files):
+    """ Write shared files the book references to the zip """
+    copied_bytes = 0
+    skipped_bytes = 0
 
-    # Automatically write mathjax to zip
-    for dirpath,dirs,files in os.walk(MATHJAX_URL):
-        for f in files:
-            zipper.write_file(os.path.join(dirpath, f), directory="shared")
+    # Mathjax loads its config and extensions itself, so include the whole tree if the book uses it
+    shared_paths = [os.path.join(SHARED_DIRECTORY, path) for path in sorted(os.listdir(SHARED_DIRECTORY)) if not path.endswith(".tmp")]
+    for dirpath,dirs,filenames in os.walk(MATHJAX_URL):
+        shared_paths.extend(sorted(os.path.join(dirpath, f) for f in filenames))
+
+    for filepath in shared_paths:
+        if filepath in shared_files or (MATHJAX_URL in shared_files and filepath.startswith(MATHJAX_URL + os.path.sep)):
+            zipper.write_file(filepath, directory="shared")
+            copied_bytes += os.path.getsize(filepath)
+        elif os.path.isfile(filepath):
+            skipped_bytes += os.path.getsize(filepath)
+
+    LOGGER.info("    Shared files: copied {} bytes, saved {} bytes by skipping unreferenced files".format(copied_bytes, skipped_bytes))
+    return copied_bytes, skipped_bytes
 
 
 def scrape_page(channel):
     """ Read main page for Saylor (https://www.saylor.org/books/) """
+    METRICS.reset()
+
+    # Transforming is cpu bound, so books get their own processes (started before any other threads)
+    if STEP == "transform":
+        pool = multiprocessing.get_context("fork").Pool(TRANSFORM_WORKERS)
+    else:
+        pool = ThreadPool(BOOK_WORKERS)
     try:
-        page = BeautifulSoup(read_source(BASE_URL, loadjs=True), 'html.parser')
+        page = read_soup(BASE_URL, loadjs=True)
         contents = page.find('div', {'class': 'main-content'}).find('div', {'class', 'row'})
 
         # Site doesn't have special designation for subjects, so get headers
+        # Books are independent of each other, so queue all of them up front
+        # and attach the results in site order once they're done
+        subjects = []
+        remaining = MAX_BOOKS
         for subject in contents.find_all('h3'):
+            if remaining is not None and remaining <= 0:
+                break
 
             # Create subject topic
             title = subject.text.replace(u'\xa0', u' ').replace('\n', '')
@@ -151,85 +394,334 @@ def scrape_page(channel):
             LOGGER.info(title)
 
             # Get list from subject
-            book_list = subject.findNext('ul')
-            for book in book_list.find_all('li'):
-                license = LICENSE
-                page_links = []
-
-                # Some books have subsections for different formats/licenses
-                # e.g. See Business-General/Miscellaneous > Information Systems for Business and Beyond
-                if book.find('small'):
-                    # Determine what license to use
-                    for l in licenses.choices:
-                        if l[0] in book.find('small').text:
-                            license = l[0]
-                            break
-                    booktitle = book.contents[0]
-                    LOGGER.info("    " + booktitle)
-                    # Download one of the sublinks
-                    for sublink in book.find_all('a'):
-                        if not sublink.get('href'):
-                            continue
-                        elif "PDF" in sublink.text:
-                            category_topic.add_child(nodes.DocumentNode(
-                                source_id=source_id + os.path.basename(sublink['href']),
-                                title=booktitle,
-                                license=license,
-                                copyright_holder=COPYRIGHT_HOLDER,
-                                files=[files.DocumentFile(path=sublink['href'])]
-                            ))
-                            break # only need to download one format of the book
-                        elif "HTML" in sublink.text:
-                            html_node = scrape_book(sublink['href'], license=license)
-                            if html_node:
-                                category_topic.add_child(html_node)
-                                break # only need to download one format of the book
-
-                # Most book links go straight to an html page
-                else:
-                    page_links.append(book.find('a')['href'])
-                    html_node = scrape_book(book.find('a')['href'], license)
-                    if html_node:
-                        category_topic.add_child(html_node)
+            book_list = subject.findNext('ul').find_all('li')
+            if remaining is not None:
+                book_list, remaining = book_list[:remaining], remaining - len(book_list[:remaining])
+            if STEP == "transform":
+                books = [pool.apply_async(transform_book_listing, (str(book), source_id)) for book in book_list]
+            else:
+                books = [pool.apply_async(scrape_book_listing, (book, source_id)) for book in book_list]
+            subjects.append((category_topic, books))
+
+        for category_topic, books in subjects:
+            for book in books:
+                book_node = book.get()
+                if STEP == "transform":
+                    book_node = collect_transformed_book(*book_node)
+                if book_node:
+                    category_topic.add_child(book_node)
+
+        retry_deferred()
+
+        # Run finished, so the next run should start from the beginning
+        clear_checkpoints()
+        prune_stores()
     finally:
-        # No matter what, add link to video mapping for future runs
-        with open(VIDEO_MAP_JSON, "w") as videojson:
-            json.dump(VIDEO_MAPPING, videojson)
+        pool.terminate()
+
+        downloader.close_browser()
+        if IMAGE_OPTIMIZER:
+            IMAGE_OPTIMIZER.close()
+        if TRANSCODER:
+            TRANSCODER.close()
+        write_metrics_report()
+
+def write_metrics_report():
+    """ Write timings for the run and log where the time went """
+    summary = METRICS.write_report(METRICS_REPORT, top_n=METRICS_TOP_N)
+    LOGGER.info("Finished in {:.1f}s (report written to {}.json and {}.csv)".format(summary['wall_seconds'], METRICS_REPORT, METRICS_REPORT))
+    for stage, counts in sorted(summary['stages'].items(), key=lambda item: item[1]['self_seconds'], reverse=True):
+        LOGGER.info("    {}: {calls} calls, {self_seconds:.1f}s, {bytes} bytes, {hits} cache hits, {misses} misses, {retries} retries, {errors} errors".format(stage, **counts))
+    LOGGER.info("Slowest books:")
+    for book in summary['slowest_books']:
+        LOGGER.info("    {seconds:.1f}s {book}".format(**book))
+    LOGGER.info("Slowest pages:")
+    for page in summary['slowest_pages']:
+        LOGGER.info("    {seconds:.1f}s {book}{page}".format(**page))
+
+def clear_checkpoints():
+    """ Discard journal and staged chapters from an interrupted run """
+    JOURNAL.clear()
+    shutil.rmtree(STAGING_DIRECTORY, ignore_errors=True)
+
+def get_stores():
+    """ On-disk stores the chef fills, by name (each has stats and prune, see `python -m utils.webcache`) """
+    return [
+        ("assets", ASSET_STORE),
+        ("videos", MEDIA_STORE),
+        ("optimized", IMAGE_CACHE),
+        ("transcoded", TRANSCODE_CACHE),
+        ("archive", PAGE_ARCHIVE),
+    ]
+
+def prune_stores():
+    """ Shrink stores that went over their caps, keeping everything this run used
+        (entries left by the old http cache are only removed by `python -m utils.webcache prune`)
+    """
+    for name, store in get_stores():
+        if name == "archive" and STEP == "transform":
+            continue # Transforming only reads the archive, so it can't tell which pages are still current
+        evicted = store.prune(since=RUN_STARTED)
+        if evicted:
+            LOGGER.info("Pruned {:.1f} MB from {}".format(evicted / webcache.MB, name))
+
+def retry_deferred():
+    """ Try failed assets again now that everything else is done, rebuilding books where they now download """
+    for book_url, urls in sorted(DEFERRED.pop_all().items()):
+        recovered = [url for url, result in zip(urls, downloader.read_many(sorted(urls), reader=ASSET_STORE.fetch)) if not isinstance(result, Exception)]
+        LOGGER.info("Retried {} failed assets for {}: {} recovered".format(len(urls), book_url, len(recovered)))
+        if recovered:
+            # Zip is rebuilt at the same path, so the node already in the tree stays valid
+            scrape_book(book_url, BOOK_LICENSES[book_url], use_checkpoint=False)
+
+def transform_book_listing(book_html, source_id):
+    """ Create node for book listed on main page (runs in transform worker process)
+        Returns: node, plus the timings and failed assets the parent process needs
+    """
+    METRICS.reset()
+    book_node = scrape_book_listing(make_soup(book_html).find('li'), source_id)
+    return book_node, METRICS.get_rows(), DEFERRED.pop_all()
+
+def collect_transformed_book(book_node, metrics_rows, deferred):
+    """ Add timings and failed assets from transform worker process to this process's """
+    METRICS.merge(metrics_rows)
+    for book_url, urls in deferred.items():
+        for url in urls:
+            DEFERRED.add(book_url, url)
+    return book_node
+
+def scrape_book_listing(book, source_id):
+    """ Create node for book listed on main page (runs in book worker thread) """
+    license = LICENSE
+
+    # Some books have subsections for different formats/licenses
+    # e.g. See Business-General/Miscellaneous > Information Systems for Business and Beyond
+    if book.find('small'):
+        # Determine what license to use
+        for l in licenses.choices:
+            if l[0] in book.find('small').text:
+                license = l[0]
+                break
+        booktitle = book.contents[0]
+        LOGGER.info("    " + booktitle)
+        # Download one of the sublinks
+        for sublink in book.find_all('a'):
+            if not sublink.get('href'):
+                continue
+            elif "PDF" in sublink.text:
+                return nodes.DocumentNode(
+                    source_id=source_id + os.path.basename(sublink['href']),
+                    title=booktitle,
+                    license=license,
+                    copyright_holder=COPYRIGHT_HOLDER,
+                    files=[files.DocumentFile(path=sublink['href'])]
+                ) # only need to download one format of the book
+            elif "HTML" in sublink.text:
+                html_node = scrape_book(sublink['href'], license=license)
+                if html_node:
+                    return html_node # only need to download one format of the book
+
+    # Most book links go straight to an html page
+    else:
+        return scrape_book(book.find('a')['href'], license)
 
-def scrape_book(url, license):
-    """ Scrape book and return html node
+def scrape_book(url, license, use_checkpoint=True):
+    """ Scrape book and return html node (use_checkpoint reuses work journaled by an interrupted run)
         e.g. https://saylordotorg.github.io/text_financial-accounting/
     """
-    page = BeautifulSoup(read_source(url), 'html.parser')
+    with METRICS.scope(book=url):
+        if STEP == "fetch":
+            return fetch_book(url)
+        return build_book(url, license, use_checkpoint=use_checkpoint)
+
+def fetch_book(url):
+    """ Download book's pages, assets, and videos for the transform step without building its zip """
+    contents = read_soup(url)
+    if contents.find('div', {'id': 'book-content'}):
+        LOGGER.info("    Fetching " + contents.find('h1').text.replace(u'\xa0', u' ').replace('\n', ''))
+        prefetch_assets(url, contents)
+        fetch_page_assets(url, contents)
+        endpoints = get_chapter_endpoints(contents)
+        pool = ThreadPool(min(CHAPTER_WORKERS, len(endpoints) or 1))
+        try:
+            chapters = read_ahead(pool, METRICS.bind(lambda endpoint: read_chapter(url, endpoint)), endpoints)
+            for endpoint, chapter_contents in zip(endpoints, chapters):
+                with METRICS.scope(page=endpoint):
+                    fetch_page_assets(url, chapter_contents, endpoint)
+        finally:
+            pool.terminate()
+
+def fetch_page_assets(main_url, contents, endpoint=None):
+    """ Download files page uses that prefetch_assets doesn't (shared files and videos) """
+    for asset in get_asset_endpoints(contents):
+        if asset.startswith("shared"):
+            try:
+                write_to_shared_library_or_zip(main_url, None, endpoint=asset)
+            except Exception as e:
+                LOGGER.error("FETCH ERROR: {} ({}{})".format(str(e), main_url, asset))
+
+    for video in contents.find_all('div', {'class': 'video'}):
+        video_soup = get_video_frame(video)
+        try:
+            video_bin = video_soup and video_soup.get('src') and get_video_bin(video_soup['src'])
+            if video_bin:
+                fetch_video(video_bin, revalidate=True)
+        except Exception as e:
+            LOGGER.error("VIDEO ERROR: {} (fetching {})".format(str(e), endpoint))
+
+def build_book(url, license, use_checkpoint=True):
+    """ Build book zip and return html node (everything timed here is counted towards the book) """
+    BOOK_LICENSES[url] = license
+
+    # Skip books finished before the last run was interrupted
+    record = use_checkpoint and JOURNAL.get_book(url)
+    if record and record.get('skipped'):
+        return
+    elif record and os.path.isfile(record['zip']) and checkpoint.hash_file(record['zip']) == record['sha256']:
+        LOGGER.info("    Resuming finished book {}".format(record['title']))
+        return create_book_node(record['source_id'], record['title'], license, record['zip'])
+
+    # Table of contents is downloaded and parsed once, then rewritten in place for index.html
+    contents = read_soup(url)
 
-    if not page.find('div', {'id': 'book-content'}): # Skip books that link to other websites
+    if not contents.find('div', {'id': 'book-content'}): # Skip books that link to other websites
+        JOURNAL.record_book(url, skipped=True)
         return
 
     # Get fields for new html node
-    title = page.find('h1').text.replace(u'\xa0', u' ').replace('\n', '')
+    title = contents.find('h1').text.replace(u'\xa0', u' ').replace('\n', '')
     source_id = generate_id(title)
     write_to_path = "{}{}{}.zip".format(DOWNLOAD_DIRECTORY, os.path.sep, source_id)
     LOGGER.info("    " + title)
 
+    # Reuse the existing zip if nothing that went into it has changed
+    if INCREMENTAL:
+        book_manifest = manifest.BookManifest("{}{}{}.manifest.json".format(DOWNLOAD_DIRECTORY, os.path.sep, source_id))
+        transform_hash = get_transform_hash()
+        sources = get_source_versions(url, get_chapter_endpoints(contents))
+        assets = get_asset_versions(book_manifest.assets or {})
+        if os.path.isfile(write_to_path) and book_manifest.is_current(transform_hash, sources, assets):
+            LOGGER.info("    Skipping unchanged book {}".format(title))
+            return create_book_node(source_id, title, license, write_to_path)
+        revalidate_assets(book_manifest.assets or {}, assets)
+        book_manifest.invalidate()
+
     # Write to html zip
-    # if not os.path.isfile(write_to_path):
-    with html.HTMLWriter(write_to_path) as zipper:
+    with html.HTMLWriter(write_to_path, compression_level=ZIP_COMPRESSION_LEVEL) as zipper:
         # Parse table of contents
-        contents = BeautifulSoup(read_source(url), 'html.parser')
-        parse_page_links(url, contents, zipper)
+        shared_files = set()
+        serialization_report = {'mode': SERIALIZATION, 'pages': 0, 'seconds': 0.0, 'bytes': 0, 'prettify_bytes': 0}
+        image_report = {'images': 0, 'optimized': 0, 'resized': 0, 'converted': 0, 'bytes': 0, 'optimized_bytes': 0}
+        video_report = {'videos': 0, 'transcoded': 0, 'bytes': 0, 'transcoded_bytes': 0, 'seconds': 0.0}
+        book_assets = {kind: set() for kind in ASSET_KINDS}    # Everything the zip's pages use, for the manifest
+        add_page_assets(book_assets, get_page_assets(url, contents))
+        parse_page_links(url, contents, zipper, shared_files=shared_files, image_report=image_report, video_report=video_report)
 
         # Parse all links in the table of contents
-        for link in contents.find_all('a'):
-            if link.get('href'):
-                # Get page content and write to zip
-                chapter_contents = BeautifulSoup(read_source(url, endpoint=link['href']), 'html.parser')
-                parse_page_links(url, chapter_contents, zipper, link['href'])
-                zipper.write_contents(link['href'], chapter_contents.prettify())
+        # Chapters are downloaded and parsed in parallel, but written to the zip in
+        # table of contents order so the zip is the same from run to run
+        # Chapters journaled by an interrupted run are restored from their staged copies instead
+        # Chapters linked more than once are only written (and journaled) once
+        endpoints = list(dict.fromkeys(link['href'] for link in contents.find_all('a') if link.get('href')))
+        finished = {endpoint: get_chapter_checkpoint(url, endpoint) for endpoint in endpoints} if use_checkpoint else {}
+        pool = ThreadPool(min(CHAPTER_WORKERS, len(endpoints) or 1))
+        try:
+            chapters = read_ahead(pool, METRICS.bind(lambda endpoint: None if finished.get(endpoint) else read_chapter(url, endpoint)), endpoints)
+            for endpoint, chapter_contents in zip(endpoints, chapters):
+                with METRICS.scope(page=endpoint):
+                    if chapter_contents is None:
+                        restore_chapter(finished[endpoint], zipper, shared_files)
+                        add_page_assets(book_assets, finished[endpoint].get('assets') or {})
+                        continue
+                    written_before = set(zipper.written)
+                    shared_before = set(shared_files)
+                    page_assets = get_page_assets(url, chapter_contents)
+                    add_page_assets(book_assets, page_assets)
+                    parse_page_links(url, chapter_contents, zipper, endpoint, shared_files=shared_files,
+                        image_report=image_report, video_report=video_report)
+                    page_html = serialize_page(chapter_contents, serialization_report)
+                    zipper.write_contents(endpoint, page_html)
+                    checkpoint_chapter(url, endpoint, source_id, page_html,
+                        files={arcname: path for arcname, path in zipper.written.items() if arcname not in written_before and path},
+                        shared=shared_files - shared_before, assets=page_assets)
+        finally:
+            pool.terminate()
 
         # Write main index.html file and all shared files
-        zipper.write_index_contents(contents.prettify())
-        write_shared_library_to_zip(zipper)
-
+        zipper.write_index_contents(serialize_page(contents, serialization_report))
+        write_shared_library_to_zip(zipper, shared_files)
+        write_static_files(zipper)
+
+    LOGGER.info("    Serialized {pages} pages ({mode}) in {seconds:.2f}s: {bytes} bytes".format(**serialization_report))
+    LOGGER.debug("    Serialized pages are {prettify_bytes} bytes prettified ({saved} bytes saved)".format(
+        saved=serialization_report['prettify_bytes'] - serialization_report['bytes'], **serialization_report))
+    if OPTIMIZE_IMAGES:
+        LOGGER.info("    Images: {optimized} of {images} optimized ({resized} resized, {converted} converted): {optimized_bytes} bytes from {bytes} bytes ({saved} bytes saved)".format(
+            saved=image_report['bytes'] - image_report['optimized_bytes'], **image_report))
+    if TRANSCODE_PRESET:
+        LOGGER.info("    Videos: {transcoded} of {videos} transcoded to {preset} in {seconds:.1f}s: {transcoded_bytes} bytes from {bytes} bytes ({saved} bytes saved)".format(
+            preset=TRANSCODE_PRESET, saved=video_report['bytes'] - video_report['transcoded_bytes'], **video_report))
+    LOGGER.info("    Zip size: {files} files, {size} bytes uncompressed, {compressed_size} bytes in zip ({deflated} deflated, {stored} stored)".format(**zipper.report))
+
+    # Books with assets waiting to be retried aren't complete, so make sure they get rebuilt next time
+    if INCREMENTAL and not DEFERRED.has(url):
+        book_manifest.save(transform_hash, sources, get_stored_asset_versions(book_assets))
+
+    JOURNAL.record_book(url, source_id=source_id, title=title, license=license, zip=write_to_path, sha256=checkpoint.hash_file(write_to_path))
+    shutil.rmtree(os.path.join(STAGING_DIRECTORY, source_id), ignore_errors=True)
+
+    return create_book_node(source_id, title, license, write_to_path)
+
+def get_chapter_checkpoint(main_url, endpoint):
+    """ Get journal record for chapter if it was finished and all of its files are still around """
+    record = JOURNAL.get_chapter(main_url, endpoint)
+    if not record:
+        return None
+
+    # Shared files include the mathjax directory, so they only need to exist
+    files = [record['html']] + list(record['files'].values())
+    if all(os.path.isfile(path) for path in files) and all(os.path.exists(path) for path in record['shared']):
+        return record
+
+def checkpoint_chapter(main_url, endpoint, source_id, page_html, files, shared, assets):
+    """ Stage finished chapter and journal everything needed to write it to the zip again """
+    staged_path = os.path.join(STAGING_DIRECTORY, source_id, hashlib.sha1(endpoint.encode('utf-8')).hexdigest() + ".html")
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    with open(staged_path, 'w', encoding='utf-8') as fobj:
+        fobj.write(page_html)
+    JOURNAL.record_chapter(main_url, endpoint, html=staged_path, files=files, shared=sorted(shared), assets=assets)
+
+def restore_chapter(record, zipper, shared_files):
+    """ Write chapter finished by an interrupted run to the zip from its staged copy """
+    for arcname, path in sorted(record['files'].items()):
+        directory, filename = os.path.split(arcname)
+        zipper.write_file(path, filename=filename, directory=directory or None)
+    shared_files.update(record['shared'])
+    with open(record['html'], 'r', encoding='utf-8') as fobj:
+        zipper.write_contents(record['endpoint'], fobj.read())
+
+def serialize_page(contents, report):
+    """ Convert page to html with the configured serialization, adding its size and time to report
+        (with --debug, also its prettified size, which pages were always written with before)
+    """
+    # Minifying changes the page, so its prettified size has to be measured first
+    # Prettifying is the slow part the other modes skip, so it's only measured when asked for
+    prettify_bytes = None
+    if SERIALIZATION != "prettify" and LOGGER.isEnabledFor(logging.DEBUG):
+        with METRICS.timed("measure_prettify"):
+            prettify_bytes = len(contents.prettify().encode('utf-8'))
+
+    start = time.time()
+    with METRICS.timed("serialize"):
+        page_html = minify.serialize(contents, SERIALIZATION)
+    report['pages'] += 1
+    report['seconds'] += time.time() - start
+    report['bytes'] += len(page_html.encode('utf-8'))
+    report['prettify_bytes'] += len(page_html.encode('utf-8')) if prettify_bytes is None else prettify_bytes
+    return page_html
+
+def create_book_node(source_id, title, license, write_to_path):
+    """ Create html node for book zip """
     return nodes.HTML5AppNode(
         source_id=source_id,
         title=title,
@@ -238,61 +730,295 @@ def scrape_book(url, license):
         files=[files.HTMLZipFile(path=write_to_path)]
     )
 
-def parse_page_links(main_url, contents, zipper, endpoint=None):
-    """ Parse any links """
+def get_chapter_endpoints(contents):
+    """ Get chapter links from table of contents before parse_link removes external and xref links (each once) """
+    return list(dict.fromkeys(
+        link['href'] for link in contents.find_all('a')
+        if link.get('href') and not link['href'].startswith('http') and not ("xref" in (link.get("class") or []))
+    ))
+
+def get_source_versions(main_url, endpoints):
+    """ Get current version of book's table of contents and chapter pages """
+    urls = [get_source_url(main_url)] + [get_source_url(main_url, endpoint) for endpoint in endpoints]
+    pool = ThreadPool(min(CHAPTER_WORKERS, len(urls)))
     try:
-        # Add scripts to shared library or zip
-        for script in contents.find_all('script', {'type': 'text/javascript'}):
-            if script.get('src'):
-                if "mathjax" in script['src']: # Copy mathjax into folder
-                    filename = os.path.basename(script['src']).split("?")
-                    script['src'] = "shared/MathJax.js{}".format("?" + filename[1] if len(filename) > 1 else "")
-                else:
-                    script['src'] = write_to_shared_library_or_zip(main_url, zipper, endpoint=script['src'])
-
-        # Add stylesheets to shared library or zip
-        for link in contents.find_all('link'):
-            if link.get('href'):
-                link['href'] = write_to_shared_library_or_zip(main_url, zipper, endpoint=link['href'])
+        return dict(zip(urls, pool.map(downloader.get_version, urls)))
+    finally:
+        pool.terminate()
+
+def get_page_assets(main_url, contents):
+    """ Get what page uses before parse_page_links rewrites its links (by kind: asset store urls, shared file urls, video iframe srcs) """
+    endpoints = get_asset_endpoints(contents)
+    frames = [get_video_frame(video) for video in contents.find_all('div', {'class': 'video'})]
+    return {
+        "files": sorted({main_url + endpoint for endpoint in endpoints if not endpoint.startswith("shared")}),
+        "shared": sorted({get_source_url(main_url, endpoint) for endpoint in endpoints if endpoint.startswith("shared")}),
+        "videos": sorted({frame['src'] for frame in frames if frame and frame.get('src')}),
+    }
 
-        # Add images to shared library or zip
-        for img in contents.find_all('img'):
-            try:
-                img['src'] = write_to_shared_library_or_zip(main_url, zipper, directory="img", endpoint=img['src'])
-            except HTTPError as e:
-                img.decompose()
-                LOGGER.error("IMAGE ERROR: {} ({}{})".format(str(e), main_url, endpoint))
+def add_page_assets(book_assets, page_assets):
+    """ Add what a page uses to what its book uses """
+    for kind, keys in page_assets.items():
+        book_assets[kind].update(keys)
 
-        # Add videos to zip (skip videos that throw error)
-        for video in contents.find_all('div', {'class': 'video'}):
-            parse_video(video, zipper, endpoint=endpoint) # Path to downloaded file is set in parse_video
+def get_stored_asset_versions(book_assets):
+    """ Get versions of the assets a book was just built with, keyed the way get_asset_versions checks them
+        (videos by their bin, and assets that failed to download are left out)
+    """
+    bins = [VIDEO_CACHE.get(src) for src in sorted(book_assets["videos"])]
+    versions = {
+        "files": {url: ASSET_STORE.get_version(url) for url in sorted(book_assets["files"])},
+        "shared": get_asset_versions({"shared": book_assets["shared"]})["shared"],
+        "videos": {cached['bin']: MEDIA_STORE.get_version(cached['bin']) for cached in bins if cached and cached['bin']},
+    }
+    return {kind: {key: version for key, version in keys.items() if version} for kind, keys in versions.items()}
+
+def get_asset_versions(assets):
+    """ Get current version of each asset in a book manifest (None where it can't be checked) """
+    items = [(kind, key) for kind in ASSET_KINDS for key in sorted(assets.get(kind) or [])]
+    versions = {kind: {} for kind in ASSET_KINDS}
+    if not items:
+        return versions
+    pool = ThreadPool(min(CHAPTER_WORKERS, len(items)))
+    try:
+        for (kind, key), version in zip(items, pool.map(lambda item: get_asset_version(*item), items)):
+            versions[kind][key] = version
+    finally:
+        pool.terminate()
+    return versions
 
-        # Parse page links
-        for link in contents.find_all('a'):
+def get_asset_version(kind, key):
+    """ Get current version of asset (None if it can't be checked) """
+    try:
+        # Transform step can't reach the network, so it goes by what the fetch step stored
+        if downloader.ARCHIVE is not None and kind == "files":
+            return ASSET_STORE.get_version(key)
+        elif downloader.ARCHIVE is not None and kind == "videos":
+            return MEDIA_STORE.get_version(key)
+        return downloader.get_version(get_video_url(key) if kind == "videos" else key)
+    except Exception:
+        return None
+
+def revalidate_assets(previous, current):
+    """ Download assets that changed since the book was last built again, so the rebuilt zip doesn't use stale copies """
+    for kind in ASSET_KINDS:
+        for key, version in sorted(current[kind].items()):
+            if version is None or version == (previous.get(kind) or {}).get(key):
+                continue
             try:
-                parse_link(link)
+                if kind == "files":
+                    ASSET_STORE.fetch(key, revalidate=True)
+                elif kind == "videos":
+                    fetch_video(key, revalidate=True)
+                else:
+                    downloader.forget(key)
+                    write_shared_file(key, os.path.join(SHARED_DIRECTORY, os.path.basename(key)))
             except Exception as e:
-                LOGGER.error("LINK ERROR: {} ({}{})".format(str(e), main_url, endpoint))
-
+                LOGGER.warning("Couldn't download changed asset {}: {}".format(key, str(e)))
 
-        # Set custom styling
-        new_style_soup = BeautifulSoup("<b></b>", 'html.parser');
-        style_tag = new_style_soup.new_tag("style");
-        style_tag.string = generate_styles();
-        contents.head.append(style_tag);
-
-        # Set glossary tooltip script
-        script_tag = new_style_soup.new_tag("script");
-        script_tag.string = generate_gloss_script();
-        contents.body.append(script_tag);
+def read_ahead(pool, func, items):
+    """ Like pool.imap, but only runs a couple of items per worker ahead of the one being used
+        (otherwise workers would parse a whole book's chapters while the first ones are still being written)
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= 2 * CHAPTER_WORKERS:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def read_chapter(main_url, endpoint):
+    """ Download and parse chapter page (safe to call from worker threads) """
+    with METRICS.scope(page=endpoint):
+        chapter_contents = read_soup(main_url, endpoint=endpoint)
+        prefetch_assets(main_url, chapter_contents)
+        submit_images(main_url, chapter_contents)
+        submit_videos(chapter_contents)
+        return chapter_contents
+
+def prefetch_assets(main_url, contents):
+    """ Download page's scripts, stylesheets, and images into the asset store concurrently
+        (errors are ignored here and reported when parse_page_links writes the page)
+    """
+    urls = {main_url + endpoint for endpoint in get_asset_endpoints(contents) if not endpoint.startswith("shared")}
+    # Transform step only has what the fetch step stored, so the fetch step checks stored assets for changes
+    revalidate = STEP == "fetch"
+    downloader.read_many(sorted(urls), reader=lambda url: ASSET_STORE.fetch(url, revalidate=revalidate))
+
+def submit_images(main_url, contents):
+    """ Start optimizing page's downloaded images, so they're ready by the time the page is written """
+    if IMAGE_OPTIMIZER and STEP != "fetch":
+        for img in contents.find_all('img'):
+            path = img.get('src') and not img['src'].startswith("shared") and ASSET_STORE.lookup(main_url + img['src'])
+            if path:
+                IMAGE_OPTIMIZER.submit(path)
 
-    except requests.exceptions.ConnectionError as e:
-        LOGGER.error("ERROR: {}".format(str(e)))
+def submit_videos(contents):
+    """ Start transcoding page's videos whose links are already known, so they're ready by the time the page is written
+        (errors are ignored here and reported when parse_video writes the video)
+    """
+    if TRANSCODER and STEP != "fetch":
+        for video in contents.find_all('div', {'class': 'video'}):
+            video_soup = get_video_frame(video)
+            cached = video_soup and video_soup.get('src') and VIDEO_CACHE.get(video_soup['src'])
+            if cached and cached['bin']:
+                try:
+                    TRANSCODER.submit(fetch_video(cached['bin']))
+                except Exception:
+                    pass
+
+def fetch_video(video_bin, revalidate=False):
+    """ Get local copy of video for video bin, downloading it only if no other page has (or if it changed, when revalidating) """
+    return MEDIA_STORE.fetch(video_bin, get_video_url(video_bin), revalidate=revalidate)
+
+def write_video(video_bin, zipper, filename, report=None):
+    """ Write video to zip, transcoded when --transcode-videos is set (returns path in zip) """
+    source_path = fetch_video(video_bin)
+    if not TRANSCODER:
+        return zipper.write_file(source_path, filename=filename, directory="videos")
 
+    try:
+        with METRICS.timed("transcode_video"):
+            result = TRANSCODER.get(source_path)
+        LOGGER.info("    Video {}: {size} bytes to {transcoded_size} bytes ({preset}) in {seconds:.1f}s{cached}".format(
+            filename, cached=" (cached)" if result.get('cached') else "", **result))
     except Exception as e:
-        import pdb; pdb.set_trace()
-        print(str(e))
-
+        LOGGER.warning("Couldn't transcode video {}: {}".format(video_bin, str(e)))
+        result = {"path": source_path, "size": os.path.getsize(source_path), "seconds": 0.0}
+        result["transcoded_size"] = result["size"]
+
+    if report is not None:
+        report['videos'] += 1
+        report['transcoded'] += result['path'] != source_path
+        report['bytes'] += result['size']
+        report['transcoded_bytes'] += result['transcoded_size']
+        report['seconds'] += 0.0 if result.get('cached') else result['seconds']
+    return zipper.write_file(result['path'], filename=filename, directory="videos")
+
+def write_image(main_url, zipper, endpoint, shared_files=None, report=None):
+    """ Write image to zip, optimized when --optimize-images is set (returns path in zip) """
+    if not IMAGE_OPTIMIZER or endpoint.startswith("shared") or os.path.splitext(endpoint)[1].lower() not in images.OPTIMIZABLE_EXTENSIONS:
+        return write_to_shared_library_or_zip(main_url, zipper, directory="img", endpoint=endpoint, shared_files=shared_files)
+
+    source_path = ASSET_STORE.fetch(main_url + endpoint)
+    try:
+        with METRICS.timed("optimize_image"):
+            result = IMAGE_OPTIMIZER.get(source_path)
+    except Exception as e:
+        LOGGER.warning("Couldn't optimize image {}{}: {}".format(main_url, endpoint, str(e)))
+        result = {"path": source_path, "ext": None, "size": os.path.getsize(source_path), "resized": False}
+        result["optimized_size"] = result["size"]
+
+    if report is not None:
+        report['images'] += 1
+        report['optimized'] += result['path'] != source_path
+        report['resized'] += result['resized']
+        report['converted'] += bool(result['ext'])
+        report['bytes'] += result['size']
+        report['optimized_bytes'] += result['optimized_size']
+
+    # Converted images get the extension of their new format
+    filename = os.path.splitext(os.path.basename(endpoint))[0] + (result['ext'] or os.path.splitext(endpoint)[1])
+    return zipper.write_file(result['path'], filename=filename, directory="img")
+
+def get_asset_endpoints(contents):
+    """ Get scripts, stylesheets, and images page links to """
+    endpoints = [script['src'] for script in contents.find_all('script', {'type': 'text/javascript'}) if script.get('src') and "mathjax" not in script['src']]
+    endpoints.extend(link['href'] for link in contents.find_all('link') if link.get('href'))
+    endpoints.extend(img['src'] for img in contents.find_all('img') if img.get('src'))
+    return endpoints
+
+def parse_page_links(main_url, contents, zipper, endpoint=None, shared_files=None, image_report=None, video_report=None):
+    """ Parse any links (shared files the page uses are added to shared_files, image and video sizes to their reports) """
+    shared_files = shared_files if shared_files is not None else set()
+    with METRICS.timed("parse_page_links"):
+        try:
+            build_page_rewriter(main_url, zipper, endpoint, shared_files, image_report, video_report).rewrite(contents)
+
+            # Set custom styling (written once per zip by write_static_files)
+            contents.head.append(new_tag("link", rel="stylesheet", type="text/css", href="shared/" + STYLES_FILENAME))
+
+            # Set glossary tooltip script (runs after the page content has loaded)
+            contents.body.append(new_tag("script", type="text/javascript", src="shared/" + GLOSS_SCRIPT_FILENAME))
+
+        except requests.exceptions.ConnectionError as e:
+            LOGGER.error("ERROR: {}".format(str(e)))
+
+        except Exception as e:
+            LOGGER.error("PAGE ERROR: {} ({}{})".format(str(e), main_url, endpoint))
+
+def build_page_rewriter(main_url, zipper, endpoint, shared_files, image_report=None, video_report=None):
+    """ Set up handlers to rewrite a page in one pass over its tree """
+    page_rewriter = rewriter.DOMRewriter()
+    glossterms = collections.deque() # Glossterms waiting for the next glossdef in the page
+
+    # Add scripts to shared library or zip
+    def parse_script(script):
+        if script.get('src'):
+            if "mathjax" in script['src']: # Copy mathjax into folder
+                shared_files.add(MATHJAX_URL)
+                filename = os.path.basename(script['src']).split("?")
+                script['src'] = "shared/MathJax.js{}".format("?" + filename[1] if len(filename) > 1 else "")
+            else:
+                script['src'] = write_to_shared_library_or_zip(main_url, zipper, endpoint=script['src'], shared_files=shared_files)
+
+    # Add stylesheets to shared library or zip
+    def parse_stylesheet(link):
+        if link.get('href'):
+            link['href'] = write_to_shared_library_or_zip(main_url, zipper, endpoint=link['href'], shared_files=shared_files)
+
+    # Add images to shared library or zip
+    def parse_image(img):
+        try:
+            img['src'] = write_image(main_url, zipper, img['src'], shared_files=shared_files, report=image_report)
+        except (HTTPError, requests.exceptions.ConnectionError) as e:
+            # Only try again at the end of the run if it might work then (a 404 stays a 404)
+            if retry.is_retryable(e) or isinstance(e, retry.CircuitOpenError):
+                DEFERRED.add(main_url, main_url + img['src'])
+            img.decompose()
+            LOGGER.error("IMAGE ERROR: {} ({}{})".format(str(e), main_url, endpoint))
+            return True
+
+    # Add videos to zip (skip videos that throw error)
+    def parse_video_div(video):
+        with METRICS.timed("parse_video"):
+            return parse_video(video, zipper, endpoint=endpoint, report=video_report) # Path to downloaded file is set in parse_video
+
+    # Parse page links (glossterms are finished once their glossdef is reached)
+    def parse_page_link(link):
+        if link.get("class") and "glossterm" in link.get("class"):
+            glossterms.append(link)
+            return
+        try:
+            parse_link(link)
+        except Exception as e:
+            LOGGER.error("LINK ERROR: {} ({}{})".format(str(e), main_url, endpoint))
+
+    # Each glossdef belongs to the earliest glossterm before it that doesn't have one yet
+    def parse_glossdef(definition):
+        if glossterms:
+            parse_link(glossterms.popleft(), definition=definition)
+            return True
+
+    page_rewriter.register('script', parse_script, {'type': 'text/javascript'})
+    page_rewriter.register('link', parse_stylesheet)
+    page_rewriter.register('img', parse_image)
+    page_rewriter.register('div', parse_video_div, {'class': 'video'})
+    page_rewriter.register('a', parse_page_link)
+    page_rewriter.register('span', parse_glossdef, {'class': 'glossdef'})
+    return page_rewriter
+
+
+def write_static_files(zipper):
+    """ Write custom styles and glossary script that every page references to the zip """
+    styles = generate_styles()
+    gloss_script = generate_gloss_script()
+    if SERIALIZATION == "minified":
+        styles = minify.minify_css(styles)
+        gloss_script = minify.minify_js(gloss_script)
+    zipper.write_contents(STYLES_FILENAME, styles, directory="shared")
+    zipper.write_contents(GLOSS_SCRIPT_FILENAME, gloss_script, directory="shared")
 
 def generate_styles():
     """ Create custom style rules """
@@ -319,84 +1045,109 @@ def generate_gloss_script():
     return script_string;
 
 
-def parse_video(video, zipper, endpoint):
-    """ Parse videos and embed them directly in the page """
+def parse_video(video, zipper, endpoint, report=None):
+    """ Parse videos and embed them directly in the page (returns True if the video was removed) """
     try:
         video_link = video.find('a')
-        video_frame = video_link and video_link.get('data-iframe-code')
+        video_soup = get_video_frame(video)
         width = None
         height = None
         src = None
+        video_bin = None
 
-        # Some videos are embedded from another page, others are directly on the page
-        # e.g. https://saylordotorg.github.io/text_financial-accounting/s04-00-why-is-financial-accounting-im.html
-        if video_frame:
-            video_soup = BeautifulSoup(video_frame, 'html.parser').contents[0]
+        if video_soup:
             width = video_soup.get('width')
             height = video_soup.get('height')
             src = video_soup.get('src')
 
-        # Create soup to replace iframe with video tag
-        new_video_soup = BeautifulSoup("<b></b>", 'html.parser')
-        new_tag = new_video_soup.new_tag("video", controls=True)
+        # Create video tag to replace iframe
+        video_tag = new_tag("video", controls=True)
 
         if src:
-            # See if video link has been recorded already
-            video_bin = VIDEO_MAPPING.get(src)
-
-            # Try to download the video (sometimes fails to load)
-            video_bin = None
-            tries = 10
-            while video_bin == None and tries > 0:
-                tries -= 1
-                video_bin = BeautifulSoup(read_source(src, loadjs=True), 'html.parser').find('a')
-                if video_bin:
-                    video_bin = video_bin['href']
+            video_bin = get_video_bin(src)
 
         # Delete any video tags that failed to download
         if not video_bin:
             video.decompose()
-            return
-
-        # Set mapping for faster future runs
-        VIDEO_MAPPING[src] = video_bin
+            return True
 
         # Generate a unique video name to avoid overwriting in the zip file
         video_name = os.path.basename(video_bin) + ".mp4"
 
-        # Video urls are set to a .bin file, but only need the file.mp4 file
-        video_url = video_bin.replace(".bin", "/file.mp4")
-
         # Create new video tag and download to zip
-        new_source_soup = BeautifulSoup("<b></b>", 'html.parser')
-        video_path = write_to_shared_library_or_zip(video_url, zipper, directory="videos", filename=video_name)
-        source_tag = new_source_soup.new_tag("source", type='video/mp4', src=video_path)
-        new_tag.append(source_tag)
+        video_path = write_video(video_bin, zipper, video_name, report=report)
+        source_tag = new_tag("source", type='video/mp4', src=video_path)
+        video_tag.append(source_tag)
 
         # Set the width and height if provided
         if width:
-            new_tag['width'] = width
+            video_tag['width'] = width
         if height:
-            new_tag['height'] = height
+            video_tag['height'] = height
 
-        video_link.replaceWith(new_tag)
+        video_link.replaceWith(video_tag)
 
     except Exception as e:
         LOGGER.error("VIDEO ERROR: {} (parsing {})".format(str(e), endpoint))
 
-def parse_link(link):
-    """ Parse <a> links """
+def get_video_frame(video):
+    """ Get iframe video div embeds (None if the video is directly on the page) """
+    # Some videos are embedded from another page, others are directly on the page
+    # e.g. https://saylordotorg.github.io/text_financial-accounting/s04-00-why-is-financial-accounting-im.html
+    video_link = video.find('a')
+    video_frame = video_link and video_link.get('data-iframe-code')
+    if video_frame:
+        return BeautifulSoup(video_frame, FRAGMENT_PARSER).contents[0]
+
+def get_video_bin(src):
+    """ Get link to video bin for iframe src (None if it couldn't be found) """
+    # See if video link has been recorded already (skips the browser entirely)
+    cached = VIDEO_CACHE.get(src)
+    if cached:
+        return cached['bin']
+
+    # Try to download the video (sometimes fails to load), backing off between tries
+    video_bin = None
+    try:
+        video_bin = downloader.RETRY.call(src, load_video_bin, retryable=lambda e: isinstance(e, LookupError))
+    except LookupError:
+        pass
+    except (downloader.OfflineError, retry.CircuitOpenError):
+        raise # Only missing from the page archive or skipped for now, so the next run should still look it up
+    except Exception:
+        VIDEO_CACHE.set_failed(src)
+        raise
+
+    # Set mapping for faster future runs
+    if video_bin:
+        VIDEO_CACHE.set(src, video_bin)
+    else:
+        VIDEO_CACHE.set_failed(src)
+    return video_bin
+
+def get_video_url(video_bin):
+    """ Video urls are set to a .bin file, but only need the file.mp4 file """
+    return video_bin.replace(".bin", "/file.mp4")
+
+def load_video_bin(src):
+    """ Render video iframe and get link to the video bin (raises LookupError if it didn't load) """
+    video_link = make_soup(read_source(src, loadjs=True, wait_for='a')).find('a')
+    if not video_link or not video_link.get('href'):
+        raise LookupError("No video link found in {}".format(src))
+    return video_link['href']
+
+def parse_link(link, definition=None):
+    """ Parse <a> links (glossterms use definition, or look up the next glossdef if it isn't given) """
     page_path = os.path.basename(link.get('href') or "")
 
     # Fix the glossterms so that the description shows up correctly on hover (broken on site)
     if link.get("class") and "glossterm" in link.get("class"):
-        definition = link.findNext('span', {'class': "glossdef"})
+        definition = definition or link.findNext('span', {'class': "glossdef"})
 
         # Set glossterm as a tip with the glossdef as a span
         # e.g. <a class='tip'>Word<span>Definition of the word</span></a>
         link['class'] = "tip"
-        new_gloss_soup = BeautifulSoup("<b></b>", 'html.parser')
-        def_tag = new_gloss_soup.new_tag("span")
+        def_tag = new_tag("span")
         def_tag.string = definition.text
         link.append(def_tag)
         definition.decompose() # Remove old glossdef
@@ -0,0 +1,67 @@
+""" Image optimization keeps jpegs and image metadata intact """
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIRECTORY)
+
+from utils import blobstore, cachedworker, images
+
+EXIF_ORIENTATION = 0x0112
+
+
+@unittest.skipUnless(images.ImageOptimizer.is_available(), "Pillow is not installed")
+class OptimizeImageTest(unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image, ImageCms
+        self.directory = tempfile.mkdtemp(prefix="saylor-images-")
+        self.source_path = os.path.join(self.directory, "figure")
+        self.icc_profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION] = 6 # Rotated 90 degrees
+        image = Image.new("RGB", (400, 200), (200, 30, 30))
+        image.save(self.source_path, "JPEG", quality=95, exif=exif.tobytes(), icc_profile=self.icc_profile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def optimize(self, **options):
+        return images.optimize_image(self.source_path, os.path.join(self.directory, "optimized"), **options)
+
+    def test_leaves_jpegs_that_dont_need_resizing_alone(self):
+        result = self.optimize(max_dimension=1600)
+        self.assertEqual(result["path"], self.source_path)
+        self.assertEqual(result["optimized_size"], result["size"])
+
+    def test_keeps_orientation_and_color_profile(self):
+        from PIL import Image
+        for options in ({"max_dimension": 100}, {"image_format": "webp"}):
+            result = self.optimize(**options)
+            self.assertNotEqual(result["path"], self.source_path)
+            with Image.open(result["path"]) as image:
+                self.assertEqual(image.getexif().get(EXIF_ORIENTATION), 6)
+                self.assertEqual(image.info.get("icc_profile"), self.icc_profile)
+
+    def test_caches_results_by_store_hash(self):
+        path = blobstore.BlobStore(os.path.join(self.directory, "assets")).fetch(self.source_path)
+        hash_file = cachedworker.hash_file
+        cachedworker.hash_file = None # Stored files are named by their hash, so they aren't read to get it
+        try:
+            for cached in (False, True):
+                optimizer = images.ImageOptimizer(os.path.join(self.directory, "optimized"), max_dimension=100)
+                try:
+                    result = optimizer.get(path)
+                finally:
+                    optimizer.close()
+                self.assertNotEqual(result["path"], path)
+                self.assertEqual(result.get("cached", False), cached)
+        finally:
+            cachedworker.hash_file = hash_file
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+""" Resuming and verifying video downloads in the media store """
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIRECTORY)
+
+from utils import downloader, mediastore
+
+BODY = os.urandom(3 * downloader.CHUNK_SIZE)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """ Serves server.body with an md5 ETag, dropping the connection halfway through while server.flaky is set """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.send_header("ETag", '"{}"'.format(hashlib.md5(self.server.body).hexdigest()))
+        self.end_headers()
+
+    def do_GET(self):
+        BODY = self.server.body
+        etag = '"{}"'.format(hashlib.md5(BODY).hexdigest())
+        requested = self.headers.get("Range", "")
+        start = int(requested[len("bytes="):-1]) if requested and self.headers.get("If-Range") == etag else 0
+        self.server.ranges.append(requested or None)
+
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(BODY) - start))
+        self.send_header("ETag", etag)
+        if start:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(BODY) - 1, len(BODY)))
+        self.end_headers()
+        if self.server.flaky:
+            self.wfile.write(BODY[start:start + (len(BODY) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(BODY[start:])
+
+
+class MediaStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="saylor-media-")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.server.flaky = False
+        self.server.ranges = []
+        self.server.body = BODY
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}/video/file.mp4".format(self.server.server_address[1])
+        self.base_delay = downloader.RETRY.base_delay
+        downloader.RETRY.base_delay = 0.01
+
+    def tearDown(self):
+        downloader.RETRY.base_delay = self.base_delay
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_resumes_download_cut_off_on_last_try(self):
+        self.server.flaky = True
+        with self.assertRaises((mediastore.IncompleteDownloadError, requests.exceptions.ChunkedEncodingError)):
+            mediastore.MediaStore(self.directory).fetch("video.bin", self.url)
+
+        # Next run picks up where the last try stopped
+        self.server.flaky = False
+        self.server.ranges = []
+        path = mediastore.MediaStore(self.directory).fetch("video.bin", self.url)
+        with open(path, "rb") as fobj:
+            self.assertEqual(fobj.read(), BODY)
+        self.assertEqual(len(self.server.ranges), 1)
+        self.assertIsNotNone(self.server.ranges[0])
+
+    def test_downloads_each_key_once(self):
+        store = mediastore.MediaStore(self.directory)
+        path = store.fetch("video.bin", self.url)
+        self.assertEqual(store.fetch("video.bin", self.url), path)
+        self.assertEqual(mediastore.MediaStore(self.directory).lookup("video.bin"), path)
+        self.assertEqual(len(self.server.ranges), 1)
+
+    def test_revalidating_downloads_changed_files_again(self):
+        store = mediastore.MediaStore(self.directory)
+        path = store.fetch("video.bin", self.url)
+        self.assertEqual(store.fetch("video.bin", self.url, revalidate=True), path)
+        self.assertEqual(len(self.server.ranges), 1)
+
+        self.server.body = BODY[::-1]
+        with open(store.fetch("video.bin", self.url, revalidate=True), "rb") as fobj:
+            self.assertEqual(fobj.read(), BODY[::-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+""" Minifying the css and js the chef writes into pages """
+import os
+import sys
+import unittest
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIRECTORY)
+
+from utils import minify
+
+
+class MinifyTest(unittest.TestCase):
+
+    def test_drops_whitespace_around_punctuation(self):
+        self.assertEqual(minify.minify_js("function f ( a ) {\n    return a * 2 ;\n}"), "function f(a){return a*2;}")
+        self.assertEqual(minify.minify_css("p {\n    color : black ;\n}"), "p{color : black}")
+
+    def test_keeps_strings(self):
+        self.assertEqual(minify.minify_js("var s = 'a  ,  b' ;"), "var s='a  ,  b';")
+
+    def test_keeps_signs_apart(self):
+        self.assertEqual(minify.minify_js("var a = b + +c; var d = e - -f;"), "var a=b+ +c;var d=e- -f;")
+
+
+if __name__ == "__main__":
+    unittest.main()
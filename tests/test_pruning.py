@@ -0,0 +1,78 @@
+""" Keeping the http cache and the chef's stores under their caps """
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIRECTORY)
+
+from utils import archive, blobstore, webcache
+
+
+class PruningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="saylor-pruning-")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_source(self, name, size):
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as fobj:
+            fobj.write(os.urandom(size))
+        return path
+
+    def test_evicts_least_recently_used_blobs(self):
+        store = blobstore.BlobStore(os.path.join(self.directory, "assets"), max_size=2500)
+        sources = [self.write_source("figure{}.png".format(i), 1000) for i in range(3)]
+        paths = [store.fetch(source) for source in sources]
+        for age, path in zip((300, 200, 100), paths):
+            os.utime(path, (time.time() - age, time.time() - age))
+        store.lookup(sources[0]) # Used again, so the second blob is the oldest now
+
+        self.assertEqual(store.prune(), 1000)
+        self.assertFalse(os.path.isfile(paths[1]))
+        reopened = blobstore.BlobStore(os.path.join(self.directory, "assets"))
+        self.assertIsNone(reopened.lookup(sources[1]))
+        self.assertEqual(reopened.lookup(sources[0]), paths[0])
+
+    def test_keeps_blobs_used_by_this_run(self):
+        store = blobstore.BlobStore(os.path.join(self.directory, "assets"), max_size=0)
+        started = time.time() - 1
+        store.fetch(self.write_source("figure.png", 1000))
+        self.assertEqual(store.prune(since=started), 0)
+        self.assertEqual(store.prune(), 1000)
+
+    def test_drops_pages_archived_longest_ago(self):
+        pages = archive.PageArchive(os.path.join(self.directory, "archive", "pages"), max_size=2500)
+        for name in ("old", "middle", "new"):
+            pages.record("https://example.com/{}.html".format(name), os.urandom(1000))
+        pages.record("https://example.com/old.html", pages.get("https://example.com/old.html")) # Fetched again unchanged
+
+        self.assertGreater(pages.prune(), 0)
+        reopened = archive.PageArchive(os.path.join(self.directory, "archive", "pages"))
+        self.assertFalse(reopened.has("https://example.com/middle.html"))
+        self.assertTrue(reopened.has("https://example.com/old.html"))
+        self.assertTrue(reopened.has("https://example.com/new.html"))
+
+    def test_prunes_entries_from_old_file_cache(self):
+        directory = os.path.join(self.directory, ".webcache")
+        cache = webcache.TieredCache(directory)
+        cache.set("https://example.com/page.html", b"page")
+        legacy = os.path.join(directory, "a", "b", "c", "d", "e", "abcde" + "0" * 51)
+        os.makedirs(os.path.dirname(legacy))
+        with open(legacy, "wb") as fobj:
+            fobj.write(b"old entry")
+
+        self.assertEqual(cache.legacy.stats()['entries'], 1)
+        self.assertEqual(cache.legacy.prune(), len(b"old entry"))
+        self.assertFalse(os.path.isfile(legacy))
+        self.assertEqual(cache.get("https://example.com/page.html"), b"page")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,283 @@
+""" Runs the fetch step and then the transform step against a small local site
+
+    Usage: python -m pytest tests (or python -m unittest discover tests)
+"""
+import functools
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT_DIRECTORY)
+sys.path.append(os.path.join(ROOT_DIRECTORY, "benchmarks"))
+
+import bs4
+import replay
+import sushichef
+from utils import downloader, retry, videocache
+
+# Smallest 1x1 png
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000105fe02fea70000000049454e44ae426082"
+)
+
+SITE = {
+    "book/index.html": """<html><head><title>Test Book</title><link rel="stylesheet" href="shared/book.css"></head>
+        <body><div id="book-content"><h1>Test Book</h1>
+        <a href="s01.html">Chapter 1</a> <a href="s02.html">Chapter 2</a> <a href="http://example.com/">Elsewhere</a>
+        <a href="s01.html">Chapter 1 again</a>
+        </div></body></html>""",
+    "book/s01.html": """<html><head><link rel="stylesheet" href="shared/book.css"></head>
+        <body><div id="book-content"><p>One</p><img src="s01-figure.png"/></div></body></html>""",
+    "book/s02.html": """<html><head><script type="text/javascript" src="https://cdn.example.com/mathjax/MathJax.js?config=TeX"></script></head>
+        <body><div id="book-content"><p>Two</p><img src="s02-missing.png"/></div></body></html>""",
+    "book/shared/book.css": "p { color: black; }",
+}
+
+# Site's list of books, as the browser renders it
+MAIN_PAGE = """<div class="main-content"><div class="row">
+    <h3>Test Subject</h3><ul><li><a href="{}">Test Book</a></li></ul>
+    </div></div>"""
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class StepsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.site = tempfile.mkdtemp(prefix="saylor-site-")
+        self.workdir = tempfile.mkdtemp(prefix="saylor-work-")
+        for path, contents in SITE.items():
+            os.makedirs(os.path.dirname(os.path.join(self.site, path)), exist_ok=True)
+            with open(os.path.join(self.site, path), "w") as fobj:
+                fobj.write(contents)
+        with open(os.path.join(self.site, "book", "s01-figure.png"), "wb") as fobj:
+            fobj.write(PNG)
+
+        # Run where the chef would, with mathjax next to it (the http cache is made here too)
+        self.cwd = os.getcwd()
+        os.symlink(os.path.join(ROOT_DIRECTORY, "mathjax"), os.path.join(self.workdir, "mathjax"))
+        os.chdir(self.workdir)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=self.site))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.book_url = "http://127.0.0.1:{}/book/".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        downloader.RECORDER = None
+        downloader.ARCHIVE = None
+        sushichef.STEP = "all"
+        sushichef.SERIALIZATION = "prettify"
+        sushichef.INCREMENTAL = False
+        sushichef.DEFERRED.pop_all()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.site, ignore_errors=True)
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def build(self, step):
+        return replay.build(books=[self.book_url], workdir=self.workdir, step=step)
+
+    def test_transform_builds_fetched_book_offline(self):
+        self.build("fetch")
+        self.assertTrue(os.path.isfile(sushichef.PAGE_ARCHIVE.data_path))
+        self.assertTrue(sushichef.PAGE_ARCHIVE.has(self.book_url))
+
+        # Nothing can be downloaded from here on
+        self.server.shutdown()
+        self.server.server_close()
+        downloader.RECORDER = None
+        channel = self.build("transform")
+
+        self.assertEqual(len(channel.children), 1)
+        with zipfile.ZipFile(channel.children[0].files[0].path) as zipped:
+            names = set(zipped.namelist())
+            chapter = zipped.read("s01.html").decode("utf-8")
+        self.assertTrue({"index.html", "s01.html", "s02.html", "img/s01-figure.png", "shared/book.css"} <= names)
+        self.assertIn("img/s01-figure.png", chapter)
+        self.assertEqual(chapter.count("shared/saylor.css"), 1) # Linked twice in the TOC, but rewritten once
+
+    def test_transform_builds_books_in_worker_processes(self):
+        # Fetching uses the download pool here, so the forked workers start with a copy of it
+        self.build("fetch")
+        main_url = self.book_url.replace("book/", "books.html")
+        sushichef.PAGE_ARCHIVE.record(main_url, MAIN_PAGE.format(self.book_url), rendered=True)
+        downloader.RECORDER = None
+
+        base_url, sushichef.BASE_URL = sushichef.BASE_URL, main_url
+        channels = []
+        try:
+            thread = threading.Thread(target=lambda: channels.append(replay.build(workdir=self.workdir, step="transform")), daemon=True)
+            thread.start()
+            thread.join(60)
+        finally:
+            sushichef.BASE_URL = base_url
+        self.assertFalse(thread.is_alive(), "transform workers hung")
+
+        book = channels[0].children[0].children[0]
+        with zipfile.ZipFile(book.files[0].path) as zipped:
+            self.assertIn("img/s01-figure.png", zipped.namelist())
+
+    def test_pruning_keeps_what_the_run_used(self):
+        self.build("fetch")
+        sushichef.ASSET_STORE.files.max_size = sushichef.MEDIA_STORE.files.max_size = sushichef.PAGE_ARCHIVE.max_size = 0
+        legacy = os.path.join(".webcache", "a", "b", "c", "d", "e", "abcde" + "0" * 51)
+        os.makedirs(os.path.dirname(legacy))
+        with open(legacy, "wb") as fobj:
+            fobj.write(b"old entry")
+        os.utime(legacy, (time.time() - 3600, time.time() - 3600))
+        sushichef.prune_stores()
+        self.assertTrue(os.path.isfile(legacy)) # Old http cache is only pruned by hand
+
+        self.server.shutdown()
+        self.server.server_close()
+        downloader.RECORDER = None
+        channel = self.build("transform")
+        with zipfile.ZipFile(channel.children[0].files[0].path) as zipped:
+            self.assertIn("img/s01-figure.png", zipped.namelist())
+
+    def test_fetch_skips_unchanged_pages(self):
+        self.build("fetch")
+        size = os.path.getsize(sushichef.PAGE_ARCHIVE.data_path)
+        self.build("fetch")
+        self.assertEqual(os.path.getsize(sushichef.PAGE_ARCHIVE.data_path), size)
+
+    def test_transform_doesnt_cache_videos_missing_from_archive(self):
+        self.build("fetch")
+        self.build("transform")
+        src = "https://www.youtube.com/embed/missing"
+        with self.assertRaises(downloader.OfflineError):
+            sushichef.get_video_bin(src)
+        self.assertIsNone(sushichef.VIDEO_CACHE.get(src))
+
+    def test_linkless_iframe_doesnt_skip_its_host(self):
+        def load_video_bin(src):
+            if src.endswith("linkless"):
+                raise LookupError("No video link found in {}".format(src))
+            return src + ".bin"
+
+        retry_scheduler, video_cache, load = downloader.RETRY, sushichef.VIDEO_CACHE, sushichef.load_video_bin
+        downloader.RETRY = retry.RetryScheduler(base_delay=0)
+        sushichef.VIDEO_CACHE = videocache.VideoCache(os.path.join(self.workdir, "videos.json"))
+        sushichef.load_video_bin = load_video_bin
+        try:
+            self.assertIsNone(sushichef.get_video_bin("https://player.example.com/linkless"))
+            self.assertEqual(sushichef.get_video_bin("https://player.example.com/video"), "https://player.example.com/video.bin")
+
+            # Skipped hosts are tried again next run, not remembered as failed
+            downloader.RETRY.breaker.opened["player.example.com"] = time.time()
+            downloader.RETRY.breaker.failures["player.example.com"] = downloader.RETRY.breaker.failure_threshold
+            with self.assertRaises(retry.CircuitOpenError):
+                sushichef.get_video_bin("https://player.example.com/other")
+            self.assertIsNone(sushichef.VIDEO_CACHE.get("https://player.example.com/other"))
+        finally:
+            downloader.RETRY, sushichef.VIDEO_CACHE, sushichef.load_video_bin = retry_scheduler, video_cache, load
+
+    def test_resumed_chapters_keep_their_files(self):
+        # Interrupt the run after the chapters were written, before the book was finished
+        write_static_files = sushichef.write_static_files
+        sushichef.write_static_files = lambda zipper: sys.exit("Interrupted")
+        try:
+            with self.assertRaises(SystemExit):
+                self.build("all")
+        finally:
+            sushichef.write_static_files = write_static_files
+
+        read_chapters = []
+        read_chapter = sushichef.read_chapter
+        sushichef.read_chapter = lambda main_url, endpoint: read_chapters.append(endpoint) or read_chapter(main_url, endpoint)
+        try:
+            channel = self.build("all")
+        finally:
+            sushichef.read_chapter = read_chapter
+
+        self.assertEqual(read_chapters, [])
+        with zipfile.ZipFile(channel.children[0].files[0].path) as zipped:
+            self.assertIn("img/s01-figure.png", zipped.namelist())
+            self.assertIn("shared/MathJax.js", zipped.namelist())
+
+    def test_minified_pages_are_smaller_than_prettified(self):
+        with self.assertLogs(sushichef.LOGGER, "DEBUG") as logs:
+            replay.build(books=[self.book_url], workdir=self.workdir, serialization="minified")
+        report = next(line for line in logs.output if "prettified" in line)
+        saved = int(re.search(r"\((-?\d+) bytes saved\)", report).group(1))
+        self.assertGreater(saved, 0)
+
+    def test_minified_pages_arent_prettified(self):
+        prettified = []
+        prettify = bs4.element.Tag.prettify
+        bs4.element.Tag.prettify = lambda tag, *args, **kwargs: prettified.append(tag) or prettify(tag, *args, **kwargs)
+        try:
+            with self.assertLogs(sushichef.LOGGER, "INFO"):
+                replay.build(books=[self.book_url], workdir=self.workdir, serialization="minified")
+        finally:
+            bs4.element.Tag.prettify = prettify
+        self.assertEqual(prettified, [])
+
+    def test_incremental_build_picks_up_changed_images(self):
+        replay.build(books=[self.book_url], workdir=self.workdir, incremental=True)
+        with self.assertLogs(sushichef.LOGGER, "INFO") as logs:
+            replay.build(books=[self.book_url], workdir=self.workdir, incremental=True, fresh=True)
+        self.assertTrue(any("Skipping unchanged book" in line for line in logs.output))
+
+        # Same page, new image (Last-Modified only has whole seconds)
+        figure = os.path.join(self.site, "book", "s01-figure.png")
+        with open(figure, "ab") as fobj:
+            fobj.write(b"changed")
+        os.utime(figure, (time.time() + 10, time.time() + 10))
+        channel = replay.build(books=[self.book_url], workdir=self.workdir, incremental=True, fresh=True)
+        with zipfile.ZipFile(channel.children[0].files[0].path) as zipped:
+            self.assertEqual(zipped.read("img/s01-figure.png"), PNG + b"changed")
+
+    def test_missing_images_dont_block_manifest(self):
+        replay.build(books=[self.book_url], workdir=self.workdir, incremental=True)
+        self.assertFalse(sushichef.DEFERRED.has(self.book_url))
+        self.assertTrue(os.path.isfile(os.path.join(sushichef.DOWNLOAD_DIRECTORY, "test-book.manifest.json")))
+
+
+class ReadAheadTest(unittest.TestCase):
+
+    def test_reads_only_a_few_chapters_ahead(self):
+        started = []
+        pool = sushichef.ThreadPool(sushichef.CHAPTER_WORKERS)
+        try:
+            chapters = sushichef.read_ahead(pool, lambda endpoint: started.append(endpoint) or endpoint, range(100))
+            for endpoint in chapters:
+                self.assertLessEqual(len(started), endpoint + 2 * sushichef.CHAPTER_WORKERS)
+            self.assertEqual(sorted(started), list(range(100)))
+        finally:
+            pool.terminate()
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_creates_no_directories(self):
+        # Import a copy of the chef, since the real one sits next to the directories earlier runs made
+        directory = tempfile.mkdtemp(prefix="saylor-import-")
+        try:
+            for filename in ("sushichef.py", "client.py"):
+                shutil.copy(os.path.join(ROOT_DIRECTORY, filename), directory)
+            shutil.copytree(os.path.join(ROOT_DIRECTORY, "utils"), os.path.join(directory, "utils"),
+                ignore=shutil.ignore_patterns("__pycache__"))
+            before = set(os.listdir(directory))
+            subprocess.run([sys.executable, "-B", "-c", "import sushichef"], cwd=directory, check=True)
+            self.assertEqual(set(os.listdir(directory)), before)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+COMPACT_MIN_SIZE = 64 * 1024 * 1024     # Bytes of old records to allow before compacting on open
+COMPACT_MIN_LINES = 100000              # Old index lines to allow before compacting on open
+
+class PageArchive():
+    """
+        Raw pages saved by the fetch stage, so the transform stage can run without a network
+
+        Like a WARC file, records are appended to one data file, each a json header line
+        (url, whether the page was rendered in the browser, response headers, length)
+        followed by the body. A separate append-only index maps urls to where their
+        latest record starts, so pages can be read back without scanning the data file.
+        Pages that haven't changed since they were last archived aren't written again,
+        and old records of pages that did change are compacted away when they pile up.
+        Once the archive is over max_size, prune drops the pages archived longest ago.
+    """
+
+    def __init__(self, path, max_size=None):
+        """ Args:
+                path: (str) where to store archive (.warc and .idx are added)
+                max_size: (int) max number of bytes of pages to keep after pruning (optional, defaults to no cap)
+        """
+        self.data_path = path + ".warc"
+        self.index_path = path + ".idx"
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.records = {}           # Maps (url, rendered) to (offset of body, length, sha256 of body, date archived)
+        if os.path.isfile(self.index_path):
+            size = os.path.getsize(self.data_path) if os.path.isfile(self.data_path) else 0
+            lines = 0
+            with open(self.index_path, "r") as fobj:
+                for line in fobj:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Skip lines cut off by a crash
+                    if entry["offset"] + entry["length"] <= size:
+                        self.records[(entry["url"], entry["rendered"])] = (entry["offset"], entry["length"], entry.get("sha256"), entry.get("date", 0))
+
+            # Pages that changed leave their old records behind (and unchanged ones another index line),
+            # so drop them once they outweigh the live ones
+            if size > 2 * self._get_live_size() + COMPACT_MIN_SIZE or lines > 2 * len(self.records) + COMPACT_MIN_LINES:
+                self.compact()
+
+    def __len__(self):
+        return len(self.records)
+
+    def _get_live_size(self):
+        return sum(record[1] for record in self.records.values())
+
+    def _write(self, fobj, header, body):
+        fobj.write(json.dumps(header).encode("utf-8") + b"\n")
+        offset = fobj.tell()
+        fobj.write(body + b"\n")
+        return offset
+
+    def _get_index_line(self, header, offset, digest, date=None):
+        return json.dumps({"url": header["url"], "rendered": header["rendered"], "offset": offset, "length": header["length"],
+            "sha256": digest, "date": date or header["date"]}) + "\n"
+
+    """ RECORDER METHODS (see downloader.RECORDER) """
+
+    def record(self, url, content, rendered=False, headers=None):
+        """ record: Adds page to archive
+            Args:
+                url: (str) url page was downloaded from
+                content: (str or bytes) page contents
+                rendered: (boolean) whether page was rendered in the headless browser (optional)
+                headers: (dict) response headers (optional)
+            Returns: None
+        """
+        if not url.startswith(("http://", "https://")):
+            return
+        body = content.encode("utf-8") if isinstance(content, str) else content
+        digest = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            # Unchanged pages are already archived, so every run doesn't add another copy
+            # (only an index line, so prune knows the page is still current)
+            record = self.records.get((url, rendered))
+            header = {"url": url, "rendered": rendered, "headers": dict(headers or {}), "length": len(body), "date": time.time()}
+            if record and record[2] == digest:
+                with open(self.index_path, "a") as fobj:
+                    fobj.write(self._get_index_line(header, record[0], digest))
+                self.records[(url, rendered)] = record[:3] + (header["date"],)
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.data_path)), exist_ok=True)
+            with open(self.data_path, "ab") as fobj:
+                offset = self._write(fobj, header, body)
+            with open(self.index_path, "a") as fobj:
+                fobj.write(self._get_index_line(header, offset, digest))
+            self.records[(url, rendered)] = (offset, len(body), digest, header["date"])
+
+    def record_stream(self, url, chunks):
+        """ record_stream: Passes streamed downloads through (images and videos go to the asset store, not the archive) """
+        return chunks
+
+    """ USER-FACING METHODS """
+
+    def get(self, url, rendered=False):
+        """ get: Reads page from archive
+            Args:
+                url: (str) url page was downloaded from
+                rendered: (boolean) get the version rendered in the headless browser (optional)
+            Returns: bytes contents (str if rendered) or None if page isn't in the archive
+        """
+        record = self.records.get((url, rendered))
+        if not record:
+            return None
+        offset, length = record[:2]
+        with open(self.data_path, "rb") as fobj:
+            fobj.seek(offset)
+            body = fobj.read(length)
+        return body.decode("utf-8") if rendered else body
+
+    def has(self, url, rendered=False):
+        """ has: Checks if page is in archive
+            Args:
+                url: (str) url page was downloaded from
+                rendered: (boolean) check for the version rendered in the headless browser (optional)
+            Returns: boolean
+        """
+        return (url, rendered) in self.records
+
+    def compact(self):
+        """ compact: Rewrites archive with only the latest record for each page
+            Args: None
+            Returns: number of bytes removed
+        """
+        with self.lock:
+            if not os.path.isfile(self.data_path):
+                return 0
+            before = os.path.getsize(self.data_path)
+            records = {}
+            with open(self.data_path, "rb") as source, open(self.data_path + ".tmp", "wb") as data, open(self.index_path + ".tmp", "w") as index:
+                for line in iter(source.readline, b""):
+                    try:
+                        header = json.loads(line)
+                    except ValueError:
+                        break # Rest of the file was cut off by a crash
+                    offset = source.tell()
+                    body = source.read(header["length"])
+                    source.read(1)
+                    key = (header["url"], header["rendered"])
+                    if self.records.get(key, (None,))[0] != offset:
+                        continue # Replaced by a later record
+                    digest, date = self.records[key][2] or hashlib.sha256(body).hexdigest(), self.records[key][3]
+                    new_offset = self._write(data, header, body)
+                    index.write(self._get_index_line(header, new_offset, digest, date))
+                    records[key] = (new_offset, len(body), digest, date)
+            os.replace(self.data_path + ".tmp", self.data_path)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.records = records
+            return before - os.path.getsize(self.data_path)
+
+    def stats(self):
+        """ stats: Summarizes what's in the archive
+            Args: None
+            Returns: dict with number of pages, total bytes on disk, cap, and the oldest and newest archive dates
+        """
+        dates = [record[3] for record in self.records.values()]
+        return {
+            'entries': len(self.records),
+            'size': sum(os.path.getsize(path) for path in (self.data_path, self.index_path) if os.path.isfile(path)),
+            'max_size': self.max_size,
+            'oldest': min(dates) if dates else None,
+            'newest': max(dates) if dates else None,
+        }
+
+    def prune(self, max_size=None, since=None):
+        """ prune: Drops pages archived longest ago until the archive fits in max_size, then compacts it
+            Args:
+                max_size: (int) number of bytes of pages to shrink archive to (optional, defaults to cap)
+                since: (float) timestamp after which pages count as in use and are kept (optional)
+            Returns: number of bytes removed
+        """
+        max_size = self.max_size if max_size is None else max_size
+        with self.lock:
+            live = self._get_live_size()
+            if max_size is None or live <= max_size:
+                return 0
+            for key, record in sorted(self.records.items(), key=lambda item: item[1][3]):
+                if live <= max_size or (since is not None and record[3] >= since):
+                    break
+                del self.records[key]
+                live -= record[1]
+        return self.compact()
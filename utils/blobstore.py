@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import threading
+from utils.downloader import get_version, stream
+from utils.webcache import BoundedDirectory
+
+class IndexedStore():
+    """
+        Files stored under the SHA-256 of their bytes, with an index of what each key was stored as
+
+        The index is an append-only jsonl file of entries (the key, the file's sha256, and
+        the version it was downloaded at: ETag or Last-Modified, or the hash if the server
+        sent neither), so stored files can be revalidated and downloaded again if they
+        changed. Once the store is over max_size, prune evicts the least recently used
+        files and drops the keys that pointed at them. See BlobStore and MediaStore.
+    """
+    key_field = "key"                       # Entry field the index is keyed by
+
+    def __init__(self, directory, max_size=None):
+        """ Args:
+                directory: (str) where to store files
+                max_size: (int) max number of bytes to keep after pruning (optional, defaults to no cap)
+        """
+        self.directory = directory
+        self.files = BoundedDirectory(directory, max_size, keep=["index.jsonl"])
+        self.index_path = os.path.join(directory, "index.jsonl")
+        self.entries = {}                   # Maps keys to their latest index entry
+        self.lock = threading.Lock()
+        self.key_locks = {}                 # Makes sure threads don't download the same key at once
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as fobj:
+                for line in fobj:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Skip lines cut off by a crash
+                    self.entries[entry[self.key_field]] = entry
+
+    def _get_key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _record(self, entry):
+        # Index is append-only so recording a key doesn't rewrite the whole file
+        with self.lock:
+            self.entries[entry[self.key_field]] = entry
+            with open(self.index_path, "a") as fobj:
+                fobj.write(json.dumps(entry) + "\n")
+
+    def _compact_index(self):
+        # Drop keys whose files were evicted (and lines for keys that were recorded more than once)
+        with self.lock:
+            self.entries = {key: entry for key, entry in self.entries.items() if os.path.isfile(self.get_path(entry["sha256"]))}
+            if not os.path.isfile(self.index_path):
+                return
+            with open(self.index_path + ".tmp", "w") as fobj:
+                for entry in self.entries.values():
+                    fobj.write(json.dumps(entry) + "\n")
+            os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _is_current(self, key, url):
+        # Stored copy is kept if the version can't be checked (e.g. offline)
+        try:
+            return self.entries[key].get("url", key) == url and get_version(url) == self.get_version(key)
+        except Exception:
+            return True
+
+    def _store(self, temppath, digest):
+        # Move finished download into place under its hash
+        path = self.get_path(digest)
+        if os.path.isfile(path):
+            os.remove(temppath) # Same contents already stored under another key
+            self.files.touch(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temppath, path)
+        return path
+
+    """ USER-FACING METHODS """
+
+    def get_path(self, digest):
+        """ get_path: Gets location of stored file
+            Args:
+                digest: (str) SHA-256 hex digest of file
+            Returns: str path to file
+        """
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, key):
+        """ lookup: Gets stored file for key without downloading it
+            Args:
+                key: (str) key to look up
+            Returns: str path to file or None if key hasn't been stored
+        """
+        entry = self.entries.get(key)
+        if entry:
+            path = self.get_path(entry["sha256"])
+            # Entries that record a size (e.g. media) don't count a file cut short as stored
+            if os.path.isfile(path) and entry.get("size") in (None, os.path.getsize(path)):
+                self.files.touch(path)
+                return path
+
+    def get_version(self, key):
+        """ get_version: Gets version key was stored at
+            Args: key: (str) key to look up
+            Returns: str ETag or Last-Modified header (or SHA-256 of contents) or None if key hasn't been stored
+        """
+        if self.lookup(key):
+            return self.entries[key].get("version") or self.entries[key]["sha256"]
+
+    def stats(self):
+        """ stats: Summarizes what's in the store
+            Args: None
+            Returns: dict with number of files, total bytes, cap, and the oldest and newest use times
+        """
+        return self.files.stats()
+
+    def prune(self, max_size=None, since=None):
+        """ prune: Evicts least recently used files until store fits in max_size
+            Args:
+                max_size: (int) number of bytes to shrink store to (optional, defaults to cap)
+                since: (float) timestamp after which files count as in use and are kept (optional)
+            Returns: number of bytes evicted
+        """
+        evicted = self.files.prune(max_size, since=since)
+        if evicted:
+            self._compact_index()
+        return evicted
+
+
+class BlobStore(IndexedStore):
+    """
+        Content-addressed store for downloaded files
+
+        Urls are mapped to the hash they downloaded to, so each url is fetched at most
+        once and identical files from different urls share the same blob on disk. Blobs
+        evicted by prune are downloaded again the next time they're needed.
+    """
+    key_field = "url"
+
+    def fetch(self, url, revalidate=False):
+        """ fetch: Gets local copy of url, downloading it if it isn't in the store yet
+            Args:
+                url: (str) url or local path to download
+                revalidate: (boolean) check if url changed since it was stored and download it again if so (optional)
+            Returns: str path to blob
+        """
+        with self._get_key_lock(url):
+            path = self.lookup(url)
+            if path and (not revalidate or self._is_current(url, url)):
+                return path
+
+            # Stream into a temporary file, hashing as we go
+            headers = {}
+            hasher = hashlib.sha256()
+            os.makedirs(self.directory, exist_ok=True)
+            temppath = os.path.join(self.directory, "{}.tmp".format(threading.get_ident()))
+            try:
+                with open(temppath, "wb") as fobj:
+                    for chunk in stream(url, headers=headers):
+                        hasher.update(chunk)
+                        fobj.write(chunk)
+                digest = hasher.hexdigest()
+                path = self._store(temppath, digest)
+            finally:
+                if os.path.isfile(temppath):
+                    os.remove(temppath)
+
+            self._record({"url": url, "sha256": digest, "version": headers.get("ETag") or headers.get("Last-Modified") or digest})
+            return path
@@ -0,0 +1,129 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import Future
+from utils.checkpoint import hash_file
+
+# Name of a file stored under its SHA-256 (see blobstore.IndexedStore.get_path)
+DIGEST_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+
+def get_digest(path):
+    """ get_digest: Gets SHA-256 of file, only reading it if it isn't stored under its hash
+        Args: path: (str) file to hash
+        Returns: str hex digest
+
+        Files from the asset and media stores are named <first two of hash>/<hash>, so
+        large videos aren't read again every time they're referenced
+    """
+    name = os.path.basename(path)
+    if DIGEST_NAME.match(name) and os.path.basename(os.path.dirname(path)) == name[:2]:
+        return name
+    return hash_file(path)
+
+
+class CachedWorker():
+    """
+        Processes each unique file once on a pool of workers, caching results on disk
+
+        Results are cached by the hash of the file and the settings used, so the same file
+        in several books (or runs) is only processed the first time. Files can be submitted
+        as soon as they're downloaded and collected later. Subclasses give the job to run
+        (_get_job) and the pool to run it on (_create_executor).
+    """
+
+    def __init__(self, directory, settings, workers=None):
+        """ Args:
+                directory: (str) where to cache results
+                settings: (str) what results depend on besides the file (part of cached results' names)
+                workers: (int) number of files to process at once (optional)
+        """
+        self.directory = directory
+        self.settings = settings
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = {}           # Maps source paths to futures for their results
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _create_executor(self):
+        raise NotImplementedError
+
+    def _get_job(self, source_path, output_path):
+        """ Function that processes source_path into output_path (plus extension) and returns its result dict """
+        raise NotImplementedError
+
+    def _get_executor(self):
+        # Pool is started on first use, so processes that never submit anything (or were forked) don't inherit one
+        if not self.executor:
+            self.executor = self._create_executor()
+        return self.executor
+
+    def _save_result(self, output_path, result):
+        # Result is written next to the output so later runs can skip it
+        with open(output_path + ".json.tmp", "w") as fobj:
+            json.dump(result, fobj)
+        os.replace(output_path + ".json.tmp", output_path + ".json")
+        return result
+
+    def _finish(self, future, output_path, done):
+        try:
+            future.set_result(self._save_result(output_path, done.result()))
+        except Exception as e:
+            future.set_exception(e)
+
+    """ USER-FACING METHODS """
+
+    def submit(self, source_path):
+        """ submit: Starts processing file if it isn't cached or already being processed
+            Args: source_path: (str) file to process
+            Returns: concurrent.futures.Future for the result (see get)
+        """
+        with self.lock:
+            future = self.futures.get(source_path)
+            if future:
+                return future
+            future = self.futures[source_path] = Future()
+
+        # Hashing a large file takes a while, so it's done outside the lock
+        try:
+            output_path = os.path.join(self.directory, "{}-{}".format(get_digest(source_path), self.settings))
+            if os.path.isfile(output_path + ".json"):
+                with open(output_path + ".json") as fobj:
+                    result = json.load(fobj)
+                if os.path.isfile(result["path"]):
+                    for path in (output_path + ".json", result["path"]):
+                        os.utime(path) # Mark as recently used so pruning keeps it
+                    future.set_result(dict(result, cached=True))
+                    return future
+
+            job = self._get_job(source_path, output_path)
+            with self.lock:
+                executor = self._get_executor()
+            if executor:
+                executor.submit(job).add_done_callback(lambda done: self._finish(future, output_path, done))
+            else:
+                future.set_result(self._save_result(output_path, job()))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def get(self, source_path):
+        """ get: Gets result for file, waiting for it if it's still being processed
+            Args: source_path: (str) file to process
+            Returns: dict result (with cached set if an earlier run processed it)
+        """
+        return self.submit(source_path).result()
+
+    def close(self):
+        """ close: Waits for running jobs and shuts down workers
+            Args: None
+            Returns: None
+        """
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown()
+                self.executor = None
+            self.futures = {}
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import threading
+
+def hash_file(path):
+    """ hash_file: Gets SHA-256 of file contents
+        Args: path: (str) file to hash
+        Returns: str hex digest
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class Journal():
+    """
+        Append-only record of finished books and chapters, so an interrupted run
+        can pick up where it stopped instead of starting from the first subject
+    """
+
+    def __init__(self, path):
+        """ Args: path: (str) where to store journal """
+        self.path = path
+        self.lock = threading.Lock()
+        self.books = {}             # Maps book urls to book records
+        self.chapters = {}          # Maps (book url, endpoint) to chapter records
+        if os.path.isfile(path):
+            with open(path, "r") as fobj:
+                for line in fobj:
+                    try:
+                        self._load(json.loads(line))
+                    except ValueError:
+                        continue # Skip lines cut off by a crash
+
+    def _load(self, record):
+        if record["type"] == "book":
+            self.books[record["url"]] = record
+        elif record["type"] == "chapter":
+            self.chapters[(record["url"], record["endpoint"])] = record
+
+    def _append(self, record):
+        with self.lock:
+            self._load(record)
+            with open(self.path, "a") as fobj:
+                fobj.write(json.dumps(record) + "\n")
+                fobj.flush()
+                os.fsync(fobj.fileno())
+
+    """ USER-FACING METHODS """
+
+    def record_book(self, url, **fields):
+        """ record_book: Records finished book
+            Args:
+                url: (str) book url
+                fields: data needed to recreate the book's node (source_id, title, zip path, hash, ...)
+            Returns: None
+        """
+        self._append(dict(fields, type="book", url=url))
+
+    def record_chapter(self, url, endpoint, **fields):
+        """ record_chapter: Records finished chapter
+            Args:
+                url: (str) book url
+                endpoint: (str) chapter link in book's table of contents
+                fields: data needed to write the chapter again without fetching it (staged html path, files, ...)
+            Returns: None
+        """
+        self._append(dict(fields, type="chapter", url=url, endpoint=endpoint))
+
+    def get_book(self, url):
+        """ get_book: Gets record for finished book
+            Args: url: (str) book url
+            Returns: dict record or None if book isn't finished
+        """
+        return self.books.get(url)
+
+    def get_chapter(self, url, endpoint):
+        """ get_chapter: Gets record for finished chapter
+            Args:
+                url: (str) book url
+                endpoint: (str) chapter link in book's table of contents
+            Returns: dict record or None if chapter isn't finished
+        """
+        return self.chapters.get((url, endpoint))
+
+    def clear(self):
+        """ clear: Removes journal once the run has finished
+            Args: None
+            Returns: None
+        """
+        with self.lock:
+            self.books = {}
+            self.chapters = {}
+            if os.path.isfile(self.path):
+                os.remove(self.path)
@@ -1,50 +1,399 @@
 import asyncio
+import atexit
+import functools
+import hashlib
 import os
 import requests
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
 from pyppeteer import launch
+from pyppeteer.errors import PageError, TimeoutError as PageTimeoutError
 
 from requests_file import FileAdapter
-from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter, InvalidatingCacheControlAdapter
+from ricecooker.utils.caching import CacheControlAdapter
+from utils.metrics import METRICS
+from utils.retry import RetryScheduler, is_retryable
+from utils.webcache import TieredCache, RevalidatingHeuristic
+
+ASYNC_WORKERS = 16                                             # Max downloads in flight for aread/read_many
+HOST_CONCURRENCY = 4                                           # Max downloads in flight per host for aread/read_many
+POLITENESS_DELAY = 0.1                                         # Seconds between starting downloads from the same host
+
+# Retries are handled by RETRY (backoff, jitter, and per-host circuit breakers)
+# rather than by the session adapters
+RETRY = RetryScheduler()
 
 DOWNLOAD_SESSION = requests.Session()                          # Session for downloading content from urls
-DOWNLOAD_SESSION.mount('https://', requests.adapters.HTTPAdapter(max_retries=3))
 DOWNLOAD_SESSION.mount('file://', FileAdapter())
-cache = FileCache('.webcache')
-forever_adapter= CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
+cache = TieredCache('.webcache')                                # Size-capped, see `python -m utils.webcache`
+cache_adapter = CacheControlAdapter(heuristic=RevalidatingHeuristic(), cache=cache, pool_maxsize=ASYNC_WORKERS)
+
+DOWNLOAD_SESSION.mount('http://', cache_adapter)
+DOWNLOAD_SESSION.mount('https://', cache_adapter)
+
+CHUNK_SIZE = 1024 * 1024                                       # Bytes to read at a time when streaming downloads
+
+# Offline runs (see benchmarks/replay.py): REPLAY_URL sends every http(s) download to a local
+# snapshot server instead, and RECORDER is given everything downloaded so it can be saved as one
+REPLAY_URL = None           # e.g. "http://127.0.0.1:8000"
+RECORDER = None             # Has record(url, content, rendered, headers) and record_stream(url, chunks) -> chunks
+
+# Transform stage (see sushichef.py --stage): pages are read from this PageArchive and nothing
+# is requested from the network
+ARCHIVE = None
+
+
+class OfflineError(requests.exceptions.ConnectionError):
+    """ Raised for urls that would need the network while reading from ARCHIVE """
+    pass
+
+class SelectorTimeoutError(LookupError):
+    """ Raised when a rendered page never shows the element it was loaded for (not retried by read) """
+    pass
+
+# The cache adapter buffers whole response bodies in memory to store them, so streamed
+# downloads go through a session without it
+STREAM_SESSION = requests.Session()
+STREAM_SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=ASYNC_WORKERS))
+STREAM_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=ASYNC_WORKERS))
+STREAM_SESSION.mount('file://', FileAdapter())
+
+
+class BrowserPool():
+    """
+        Headless browser shared by the whole run
+
+        The browser lives on its own event loop thread so any thread can load pages
+        through it, and open tabs are reused between loads.
+    """
+
+    def __init__(self, max_pages=4, timeout=30, selector_timeout=10):
+        """ Args:
+                max_pages: (int) maximum number of tabs to have open at once
+                timeout: (int) seconds to wait for a page to load
+                selector_timeout: (int) seconds to wait for wait_for to show up once the page has loaded
+        """
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.selector_timeout = selector_timeout
+        self.loop = None            # Event loop the browser runs on
+        self.thread = None          # Thread running the event loop
+        self.browser = None         # Shared browser
+        self.idle_pages = []        # Open tabs that aren't loading anything
+        self.lock = threading.Lock()
+
+    async def _launch(self):
+        # Signal handlers can only be installed from the main thread
+        self.browser = await launch({'headless': True, 'handleSIGINT': False, 'handleSIGTERM': False, 'handleSIGHUP': False})
+        self.semaphore = asyncio.Semaphore(self.max_pages)
+
+    async def _load(self, path, wait_for=None):
+        async with self.semaphore:
+            page = self.idle_pages.pop() if self.idle_pages else await self.browser.newPage()
+            try:
+                if wait_for:
+                    # Embedded players and analytics never stop polling, so only wait for the
+                    # document and then for the element the caller needs
+                    await page.goto(path, {'waitUntil': 'domcontentloaded', 'timeout': self.timeout * 1000})
+                    try:
+                        await page.waitForSelector(wait_for, {'timeout': self.selector_timeout * 1000})
+                    except PageTimeoutError:
+                        raise SelectorTimeoutError("{} not found in {}".format(wait_for, path))
+                else:
+                    # Wait for the network to go quiet rather than sleeping a fixed amount of time
+                    try:
+                        await page.goto(path, {'waitUntil': 'networkidle0', 'timeout': self.timeout * 1000})
+                    except PageTimeoutError:
+                        pass # Some pages never stop polling, so read whatever has loaded
+                content = await page.evaluate('document.body.innerHTML', force_expr=True)
+            except Exception:
+                await page.close()
+                raise
+            self.idle_pages.append(page)
+            return content
 
-DOWNLOAD_SESSION.mount('http://', forever_adapter)
-DOWNLOAD_SESSION.mount('https://', forever_adapter)
+    def start(self):
+        """ start: Launches browser if it isn't running yet
+            Args: None
+            Returns: None
+        """
+        with self.lock:
+            if self.loop:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(self._launch(), self.loop).result()
+            except Exception:
+                self._stop_loop()
+                raise
 
+    def _stop_loop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = self.thread = self.browser = None
+        self.idle_pages = []
 
-def read(path, loadjs=False, session=None, driver=None):
+    def load(self, path, wait_for=None):
+        """ load: Loads page in browser and returns the rendered body
+            Args:
+                path: (str) url to load
+                wait_for: (str) css selector to wait for before reading the page (optional)
+            Returns: str body html
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self._load(path, wait_for=wait_for), self.loop).result()
+
+    def close(self):
+        """ close: Shuts down browser and its event loop
+            Args: None
+            Returns: None
+        """
+        with self.lock:
+            if not self.loop:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self.browser.close(), self.loop).result(self.timeout)
+            finally:
+                self._stop_loop()
+
+    def forget(self):
+        """ forget: Drops the browser without closing it (for forked processes, where it belongs to the parent)
+            Args: None
+            Returns: None
+        """
+        self.lock = threading.Lock()
+        self.loop = self.thread = self.browser = None
+        self.idle_pages = []
+
+BROWSER = BrowserPool()
+atexit.register(BROWSER.close)
+
+
+def read(path, loadjs=False, session=None, driver=None, wait_for=None):
     """ read: Reads from source and returns contents
         Args:
             path: (str) url or local path to download
             loadjs: (boolean) indicates whether to load js (optional)
             session: (requests.Session) session to use to download (optional)
             driver: (selenium.webdriver) webdriver to use to download (optional)
+            wait_for: (str) css selector to wait for when loading js (optional)
         Returns: str content from file or page
     """
     session = session or DOWNLOAD_SESSION
+    with METRICS.timed("load_page" if loadjs else "read_source"):
+        headers = {}
+        try:
+            if ARCHIVE is not None and _is_url(path):           # Read page from archive when working offline
+                content = _get_archived(path, loadjs)
+            elif loadjs:                                        # Wait until js loads then return contents
+                content = RETRY.call(get_download_url(path), load_page, wait_for=wait_for, retryable=_is_retryable_page)
+            else:                                               # Read page contents from url
+                content, headers = RETRY.call(get_download_url(path), _get_content, session)
+        except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema):
+            with open(path, 'rb') as fobj:                      # If path is a local file path, try to open the file
+                content = fobj.read()
+        METRICS.add(bytes=len(content))
+        if RECORDER is not None:                                # Recorders skip anything that isn't a url
+            RECORDER.record(path, content, rendered=loadjs, headers=headers)
+        return content
+
+def _is_url(path):
+    return urlparse(path).scheme in ('http', 'https')
+
+def _get_archived(path, rendered):
+    content = ARCHIVE.get(path, rendered=rendered)
+    if content is None:
+        raise OfflineError("{} is not in the page archive (run the fetch stage again)".format(path))
+    METRICS.add(hits=1)
+    return content
+
+def get_download_url(path):
+    """ get_download_url: Gets url to actually request for path (changes only when replaying a snapshot)
+        Args: path: (str) url or local path to download
+        Returns: str url, e.g. http://127.0.0.1:8000/https/saylordotorg.github.io/index.html when replaying
+    """
+    parsed = urlparse(path)
+    if not REPLAY_URL or not _is_url(path):
+        return path
+    return "{}/{}/{}{}".format(REPLAY_URL.rstrip('/'), parsed.scheme, parsed.netloc, path.split(parsed.netloc, 1)[1])
+
+def _is_retryable_page(error):
+    return isinstance(error, (PageError, PageTimeoutError)) or is_retryable(error)
+
+def _get_content(path, session):
+    response = session.get(path, stream=True)
+    response.raise_for_status()
+    if path.startswith('http'):
+        METRICS.add(**{'hits' if getattr(response, 'from_cache', False) else 'misses': 1})
+    return response.content, dict(response.headers)
+
+def _get_stream(path, session, chunk_size, headers=None):
+    response = session.get(path, stream=True)
+    response.raise_for_status()
+    if headers is not None:
+        headers.update(response.headers)
+    return response.iter_content(chunk_size=chunk_size)
+
+def forget(path):
+    """ forget: Drops cached response for url, so the next read downloads it again
+        Args: path: (str) url to forget
+        Returns: None
+    """
+    cache.delete(cache_adapter.controller.cache_url(get_download_url(path)))
+
+def get_version(path, session=None):
+    """ get_version: Gets an identifier that changes whenever the source changes
+        Args:
+            path: (str) url or local path to check
+            session: (requests.Session) session to use to download (optional)
+        Returns: str ETag or Last-Modified header, falling back to a hash of the contents
+    """
+    session = session or STREAM_SESSION
+    if ARCHIVE is not None:
+        return hashlib.sha256(read(path)).hexdigest()
     try:
-        if loadjs:                                              # Wait until js loads then return contents
-            content = asyncio.get_event_loop().run_until_complete(load_page(path))
-            return content
-        else:                                                   # Read page contents from url
-            response = DOWNLOAD_SESSION.get(path, stream=True)
-            response.raise_for_status()
-            return response.content
+        response = RETRY.call(get_download_url(path), session.head, allow_redirects=True)
+        if response.ok:
+            version = response.headers.get('ETag') or response.headers.get('Last-Modified')
+            if version:
+                return version
     except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema):
-        with open(path, 'rb') as fobj:                          # If path is a local file path, try to open the file
-            return fobj.read()
-
-async def load_page(path):
-    browser = await launch({'headless': True})
-    page = await browser.newPage()
-    await page.goto(path)
-    time.sleep(5)
-    content = await page.evaluate('document.body.innerHTML', force_expr=True)
-    await browser.close()
-    return content
+        pass
+    return hashlib.sha256(read(path)).hexdigest()
+
+def stream(path, chunk_size=CHUNK_SIZE, session=None, headers=None):
+    """ stream: Opens source for reading in chunks, so large files never have to fit in memory
+        Args:
+            path: (str) url or local path to download
+            chunk_size: (int) number of bytes per chunk (optional)
+            session: (requests.Session) session to use to download (optional)
+            headers: (dict) filled in with the response headers, e.g. to get the ETag (optional)
+        Returns: iterator of bytes chunks (request errors are raised before this returns)
+    """
+    session = session or STREAM_SESSION
+    if ARCHIVE is not None and _is_url(path):
+        raise OfflineError("{} was not downloaded by the fetch stage".format(path))
+    try:
+        chunks = RETRY.call(get_download_url(path), _get_stream, session, chunk_size, headers)
+        return RECORDER.record_stream(path, chunks) if RECORDER is not None else chunks
+    except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema):
+        return _iter_file(path, chunk_size)
+
+def _iter_file(path, chunk_size):
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(chunk_size), b''):
+            yield chunk
+
+def load_page(path, wait_for=None):
+    """ load_page: Renders page in the shared headless browser
+        Args:
+            path: (str) url to load
+            wait_for: (str) css selector to wait for before reading the page (optional)
+        Returns: str body html
+    """
+    return BROWSER.load(path, wait_for=wait_for)
+
+def close_browser():
+    """ close_browser: Shuts down the shared headless browser (reopens on next loadjs read) """
+    BROWSER.close()
+
+
+class HostThrottle():
+    """
+        Limits how many downloads run at once for each host, and how quickly they start
+    """
+
+    def __init__(self, max_concurrency=HOST_CONCURRENCY, delay=POLITENESS_DELAY):
+        """ Args:
+                max_concurrency: (int) max downloads in flight per host
+                delay: (float) seconds between starting downloads from the same host
+        """
+        self.max_concurrency = max_concurrency
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.semaphores = {}        # Maps hosts to semaphores limiting concurrent downloads
+        self.next_start = {}        # Maps hosts to the earliest time the next download can start
+
+    def run(self, path, func, *args, **kwargs):
+        """ run: Calls func once host has capacity and the politeness delay has passed
+            Args:
+                path: (str) url being downloaded (local paths aren't throttled)
+                func: (function) function that downloads path
+            Returns: result of func
+        """
+        host = urlparse(path).netloc
+        if not host:
+            return func(path, *args, **kwargs)
+
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, threading.BoundedSemaphore(self.max_concurrency))
+        with semaphore:
+            with self.lock:
+                now = time.time()
+                start = max(now, self.next_start.get(host, now))
+                self.next_start[host] = start + self.delay
+            if start > now:
+                time.sleep(start - now)
+            return func(path, *args, **kwargs)
+
+THROTTLE = HostThrottle()
+EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_WORKERS)
+
+def _reset_after_fork():
+    # Threads don't survive a fork (e.g. transform worker processes), so the child would wait
+    # forever on the parent's download workers and browser loop: start it with its own
+    global THROTTLE, EXECUTOR
+    THROTTLE = HostThrottle()
+    EXECUTOR = ThreadPoolExecutor(max_workers=ASYNC_WORKERS)
+    BROWSER.forget()
+
+# Not available on Windows, which can't fork anyway
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def arun(func, path, *args, **kwargs):
+    """ arun: Runs blocking download function on the shared download pool with per-host limits
+        Args:
+            func: (function) function that downloads path (e.g. read)
+            path: (str) url or local path to download
+        Returns: result of func
+    """
+    # Downloads are counted towards whichever book and page asked for them
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(EXECUTOR, METRICS.bind(functools.partial(THROTTLE.run, path, func, *args, **kwargs)))
+
+async def aread(path, loadjs=False, wait_for=None):
+    """ aread: Reads from source without blocking the event loop (uses the same cache as read)
+        Args:
+            path: (str) url or local path to download
+            loadjs: (boolean) indicates whether to load js (optional)
+            wait_for: (str) css selector to wait for when loading js (optional)
+        Returns: str content from file or page
+    """
+    return await arun(read, path, loadjs=loadjs, wait_for=wait_for)
+
+def read_many(paths, reader=None, return_exceptions=True):
+    """ read_many: Reads several sources concurrently
+        Args:
+            paths: ([str]) urls or local paths to download
+            reader: (function) function to download each path with (optional, defaults to read)
+            return_exceptions: (boolean) return errors in place of results instead of raising (optional)
+        Returns: list of results in the same order as paths
+    """
+    async def gather():
+        return await asyncio.gather(*[arun(reader or read, path) for path in paths], return_exceptions=return_exceptions)
+
+    # Use a new loop so this can be called from any thread
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(gather())
+    finally:
+        loop.close()
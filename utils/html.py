@@ -1,6 +1,14 @@
 import os
+import tempfile
 import zipfile
-from utils.downloader import read
+from utils.downloader import stream
+from utils.metrics import METRICS
+
+# Formats that are already compressed, so deflating them only costs time
+STORED_EXTENSIONS = {
+    ".mp4", ".webm", ".mp3", ".ogg", ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".zip", ".gz", ".pdf", ".woff", ".woff2",
+}
 
 class HTMLWriter():
     """
@@ -10,10 +18,16 @@ class HTMLWriter():
     zf = None               # Zip file to write to
     write_to_path = None    # Where to write zip file
 
-    def __init__(self, write_to_path):
-        """ Args: write_to_path: (str) where to write zip file """
+    def __init__(self, write_to_path, compression_level=6):
+        """ Args:
+                write_to_path: (str) where to write zip file
+                compression_level: (int) deflate level for text files, 0 stores everything uncompressed (optional)
+        """
         self.map = {}                       # Keeps track of content to write to csv
+        self.written = {}                   # Maps names of files already in the zip to the local file they came from (if any)
         self.write_to_path = write_to_path  # Where to write zip file
+        self.compression_level = compression_level
+        self.report = None                  # Size report, available once zip is closed
 
     def __enter__(self):
         """ Called when opening context (e.g. with HTMLWriter() as writer: ) """
@@ -24,18 +38,47 @@ class HTMLWriter():
         """ Called when closing context """
         self.close()
 
+    def _get_compress_type(self, filename):
+        if self.compression_level and os.path.splitext(filename)[1].lower() not in STORED_EXTENSIONS:
+            return zipfile.ZIP_DEFLATED
+        return zipfile.ZIP_STORED
+
+    def _get_zipinfo(self, filename):
+        info = zipfile.ZipInfo(filename, date_time=(2013, 3, 14, 1, 59, 26))
+        info.comment = "HTML FILE".encode()
+        info.compress_type = self._get_compress_type(filename)
+        info.create_system = 0
+        return info
+
     def _write_to_zipfile(self, filename, content):
-        if filename not in self.zf.namelist():
-            info = zipfile.ZipInfo(filename, date_time=(2013, 3, 14, 1, 59, 26))
-            info.comment = "HTML FILE".encode()
-            info.compress_type = zipfile.ZIP_STORED
-            info.create_system = 0
-            self.zf.writestr(info, content)
+        if filename not in self.written:
+            with METRICS.timed("zip_write"):
+                self.zf.writestr(self._get_zipinfo(filename), content, compresslevel=self.compression_level or None)
+                METRICS.add(bytes=len(content.encode("utf-8") if isinstance(content, str) else content))
+            self.written[filename] = None
+
+    def _stream_to_zipfile(self, filename, chunks):
+        if filename not in self.written:
+            # Download to a temporary file first so a dropped connection doesn't leave a partial entry in the zip
+            fd, temppath = tempfile.mkstemp()
+            try:
+                with os.fdopen(fd, "wb") as fobj, METRICS.timed("download_stream"):
+                    for chunk in chunks:
+                        fobj.write(chunk)
+                        METRICS.add(bytes=len(chunk))
+                self._copy_to_zipfile(temppath, arcname=filename)
+                self.written[filename] = None # Temporary file is about to be removed
+            finally:
+                os.remove(temppath)
 
     def _copy_to_zipfile(self, filepath, arcname=None):
         filename = arcname or filepath
-        if filename not in self.zf.namelist():
-            self.zf.write(filepath, arcname=arcname)
+        if filename not in self.written:
+            with METRICS.timed("zip_write"):
+                self.zf.write(filepath, arcname=arcname, compress_type=self._get_compress_type(filename),
+                    compresslevel=self.compression_level or None)
+                METRICS.add(bytes=os.path.getsize(filepath))
+            self.written[filename] = filepath
 
     """ USER-FACING METHODS """
 
@@ -45,24 +88,39 @@ class HTMLWriter():
             Returns: None
         """
         self.zf = zipfile.ZipFile(self.write_to_path, "w")
+        self.written = {}
 
     def close(self):
         """ close: Close zipfile when done
             Args: None
             Returns: None
         """
-        index_present = 'index.html' in self.zf.namelist()
+        index_present = 'index.html' in self.written
         self.zf.close() # Make sure zipfile closes no matter what
+        self.report = self.get_size_report()
         if not index_present:
             raise ReferenceError("Invalid Zip at {}: missing index.html file (use write_index_contents method)".format(self.write_to_path))
 
+    def get_size_report(self):
+        """ get_size_report: Summarizes how much space entries take up in the zip
+            Args: None
+            Returns: dict with number of files, total size, and total compressed size, overall and by compression type
+        """
+        report = {'files': 0, 'size': 0, 'compressed_size': 0, 'stored': 0, 'deflated': 0}
+        for info in self.zf.infolist():
+            report['files'] += 1
+            report['size'] += info.file_size
+            report['compressed_size'] += info.compress_size
+            report['deflated' if info.compress_type == zipfile.ZIP_DEFLATED else 'stored'] += 1
+        return report
+
     def contains(self, filename):
         """ contains: Checks if filename exists in zip
             Args:
                 filename: (str) name of file to check for
             Returns: boolean indicating whether or not zipfile contains filename
         """
-        return filename in self.zf.namelist()
+        return filename in self.written
 
     def write_contents(self, filename, contents, directory=None):
         """ write_contents: Write contents to filename in zip
@@ -100,8 +158,13 @@ class HTMLWriter():
                 filename: (str) name of file in zip
                 directory: (str) directory in zipfile to write file to (optional)
             Returns: path to file in zip
+
+            Note: downloads are streamed, so memory use doesn't depend on file size
         """
-        return self.write_contents(filename, read(url), directory=directory)
+        filepath = "{}/{}".format(directory, filename) if directory else filename
+        if filepath not in self.written:
+            self._stream_to_zipfile(filepath, stream(url))
+        return filepath
 
     def write_index_contents(self, contents):
         """ write_index_contents: Write main index file to zip
@@ -0,0 +1,121 @@
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from utils.cachedworker import CachedWorker
+
+# Pillow is optional (pip install Pillow), images are copied as they are without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Formats worth recompressing (gifs are often animated, so they're left alone)
+OPTIMIZABLE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+
+# Formats images can be converted to ("keep" leaves each image in its own format)
+IMAGE_FORMATS = ["keep", "webp"]
+
+JPEG_QUALITY = 85           # Quality for jpegs and lossy webps that had to be re-encoded
+OPTIMIZER_VERSION = 2       # Part of cached results' names, bump when optimize_image changes its output
+
+
+def optimize_image(source_path, output_path, max_dimension=None, image_format="keep"):
+    """ optimize_image: Recompresses image, shrinking it to fit max_dimension (runs in worker process)
+        Args:
+            source_path: (str) image to optimize
+            output_path: (str) where to write optimized image, without extension
+            max_dimension: (int) largest width or height to keep (optional)
+            image_format: (str) format to convert to, one of IMAGE_FORMATS (optional)
+        Returns: dict with path to the smaller of the two images, its new extension (None if the format
+            didn't change), both sizes, and whether it was resized
+    """
+    size = os.path.getsize(source_path)
+    result = {"path": source_path, "ext": None, "size": size, "optimized_size": size, "resized": False}
+
+    with Image.open(source_path) as image:
+        source_format = image.format
+        if source_format not in ("PNG", "JPEG"):
+            return result
+        resize = bool(max_dimension and max(image.size) > max_dimension)
+
+        # Re-encoding a jpeg loses detail even at its original quality, so ones that don't need
+        # shrinking or converting are left byte for byte
+        if source_format == "JPEG" and not resize and image_format != "webp":
+            return result
+
+        # Orientation and color profile go with the image, otherwise rotated or color-managed figures change
+        metadata = {key: image.info[key] for key in ("exif", "icc_profile") if image.info.get(key)}
+        if resize:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            result["resized"] = True
+
+        if image_format == "webp":
+            # Pngs stay lossless, jpegs were lossy to begin with
+            options = {"lossless": True} if source_format == "PNG" else {"quality": JPEG_QUALITY}
+            save_format, save_extension = "WEBP", ".webp"
+        elif source_format == "PNG":
+            options = {"optimize": True}
+            save_format, save_extension = "PNG", ".png"
+        else:
+            options = {"optimize": True, "progressive": True, "quality": JPEG_QUALITY}
+            save_format, save_extension = "JPEG", ".jpg"
+
+        temppath = "{}.{}.tmp".format(output_path, os.getpid())
+        image.save(temppath, save_format, **dict(options, **metadata))
+
+    # Only use the optimized image if it's actually smaller
+    optimized_size = os.path.getsize(temppath)
+    if optimized_size < size or result["resized"]:
+        os.replace(temppath, output_path + save_extension)
+        result.update(path=output_path + save_extension, optimized_size=optimized_size)
+        if save_format == "WEBP":
+            result["ext"] = save_extension
+    else:
+        os.remove(temppath)
+    return result
+
+
+class ImageOptimizer(CachedWorker):
+    """
+        Optimizes images in a process pool, processing each unique image once
+
+        Results are cached on disk by the hash of the image and the settings used, so
+        the same figure in several books (or runs) is only recompressed the first time
+        (see CachedWorker).
+    """
+
+    def __init__(self, directory, max_dimension=None, image_format="keep", workers=None):
+        """ Args:
+                directory: (str) where to cache optimized images
+                max_dimension: (int) largest width or height to keep (optional)
+                image_format: (str) format to convert to, one of IMAGE_FORMATS (optional)
+                workers: (int) number of processes to use (optional, defaults to number of cpus)
+        """
+        settings = "{}-{}-v{}".format(max_dimension or 0, image_format, OPTIMIZER_VERSION)
+        super(ImageOptimizer, self).__init__(directory, settings, workers=workers)
+        self.max_dimension = max_dimension
+        self.image_format = image_format
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _get_executor(self):
+        # Worker processes can't start processes of their own (e.g. when books are transformed in
+        # a process pool), so images are optimized in the calling process there
+        if multiprocessing.current_process().daemon:
+            return None
+        return super(ImageOptimizer, self)._get_executor()
+
+    def _get_job(self, source_path, output_path):
+        return functools.partial(optimize_image, source_path, output_path, max_dimension=self.max_dimension, image_format=self.image_format)
+
+    """ USER-FACING METHODS """
+
+    @staticmethod
+    def is_available():
+        """ is_available: Checks if Pillow is installed
+            Args: None
+            Returns: boolean
+        """
+        return Image is not None
@@ -0,0 +1,62 @@
+import json
+import os
+
+class BookManifest():
+    """
+        Record of the inputs a book zip was built from
+
+        Used to skip rebuilding zips when neither the source pages, the assets
+        they use (scripts, stylesheets, images, and videos), nor the code that
+        transforms them have changed since the last run.
+    """
+
+    def __init__(self, path):
+        """ Args: path: (str) where to store manifest """
+        self.path = path
+        self.transform = None       # Hash of the code used to build the zip
+        self.sources = {}           # Maps source urls to their version (etag, last modified, or content hash)
+        self.assets = None          # Maps kinds of assets to their urls (or keys) and versions, None if not recorded
+        if os.path.isfile(path):
+            with open(path, "r") as fobj:
+                data = json.load(fobj)
+            self.transform = data.get("transform")
+            self.sources = data.get("sources") or {}
+            self.assets = data.get("assets")
+
+    def is_current(self, transform, sources, assets):
+        """ is_current: Checks if zip was built from the same inputs
+            Args:
+                transform: (str) hash of the code used to build the zip
+                sources: (dict) maps source urls to their current version
+                assets: (dict) maps kinds of assets to their urls (or keys) and current versions
+            Returns: boolean indicating whether or not the zip can be reused
+        """
+        return self.transform == transform and self.sources == sources and None not in sources.values() \
+            and self.assets == assets and not any(None in versions.values() for versions in assets.values())
+
+    def invalidate(self):
+        """ invalidate: Removes manifest so an interrupted build is never mistaken for a finished one
+            Args: None
+            Returns: None
+        """
+        self.transform = None
+        self.sources = {}
+        self.assets = None
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def save(self, transform, sources, assets):
+        """ save: Atomically writes manifest to disk
+            Args:
+                transform: (str) hash of the code used to build the zip
+                sources: (dict) maps source urls to their version
+                assets: (dict) maps kinds of assets to their urls (or keys) and versions
+            Returns: None
+        """
+        self.transform = transform
+        self.sources = sources
+        self.assets = assets
+        temppath = "{}.tmp".format(self.path)
+        with open(temppath, "w") as fobj:
+            json.dump({"transform": transform, "sources": sources, "assets": assets}, fobj, indent=2, sort_keys=True)
+        os.replace(temppath, self.path)
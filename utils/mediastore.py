@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import re
+
+import requests
+
+from utils import downloader
+from utils.blobstore import IndexedStore
+from utils.metrics import METRICS
+from utils.retry import is_retryable
+
+# An ETag that's a plain md5 of the file (as single-part uploads on S3-style hosts give), checked after downloading
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class IncompleteDownloadError(requests.exceptions.ConnectionError):
+    """ Raised when a download ends early or doesn't match what the server said it would be """
+    pass
+
+
+def _is_retryable_download(error):
+    return isinstance(error, (IncompleteDownloadError, requests.exceptions.ChunkedEncodingError)) or is_retryable(error)
+
+
+class MediaStore(IndexedStore):
+    """
+        Store for large media files (videos), downloaded once and resumed if interrupted
+
+        Files are keyed by what identifies the media (e.g. the video bin url), so the same
+        video embedded in several chapters or books is only downloaded once. Downloads go
+        to a partial file first, and a dropped connection picks up where it left off with
+        an http Range request instead of starting over. Finished files are checked against
+        the size the server reported (and its md5 ETag, if it has one) before being kept,
+        and indexed by their key (see IndexedStore for revalidating and pruning; prune
+        also evicts partial downloads nobody has resumed).
+    """
+
+    def __init__(self, directory, max_size=None):
+        """ Args:
+                directory: (str) where to store media
+                max_size: (int) max number of bytes to keep after pruning (optional, defaults to no cap)
+        """
+        super(MediaStore, self).__init__(directory, max_size=max_size)
+        self.partial_directory = os.path.join(directory, "partial")
+
+    def _get_partial_paths(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.partial_directory, name + ".part"), os.path.join(self.partial_directory, name + ".json")
+
+    def _download(self, url, partpath, metapath):
+        """ Download url into partpath, continuing from whatever is already there (called again on each retry) """
+        meta = {}
+        if os.path.isfile(metapath):
+            with open(metapath) as fobj:
+                meta = json.load(fobj)
+        offset = os.path.getsize(partpath) if os.path.isfile(partpath) and meta.get("url") == url else 0
+
+        # If-Range makes the server send the whole file again if it changed since the partial download started
+        headers = {}
+        if offset and meta.get("validator"):
+            headers = {"Range": "bytes={}-".format(offset), "If-Range": meta["validator"]}
+        elif offset:
+            offset = 0 # Can't tell if partial file is still the same file, so start over
+
+        response = downloader.STREAM_SESSION.get(downloader.get_download_url(url), headers=headers, stream=True)
+        if response.status_code == 416:
+            if meta.get("size") == offset:
+                return meta # Partial file was already complete
+            if os.path.isfile(partpath):
+                os.remove(partpath)
+            raise IncompleteDownloadError("Partial download of {} is bigger than the file, starting over".format(url))
+        response.raise_for_status()
+
+        if response.status_code != 206:
+            offset = 0 # Server sent the whole file
+        length = response.headers.get("Content-Length")
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        meta = {
+            "url": url,
+            "validator": response.headers.get("ETag") or response.headers.get("Last-Modified") or meta.get("validator"),
+            "etag": response.headers.get("ETag"),
+            "size": int(total) if total.isdigit() else offset + int(length) if length else None,
+        }
+        with open(metapath, "w") as fobj:
+            json.dump(meta, fobj)
+
+        with open(partpath, "ab" if offset else "wb") as fobj:
+            for chunk in response.iter_content(chunk_size=downloader.CHUNK_SIZE):
+                fobj.write(chunk)
+                METRICS.add(bytes=len(chunk))
+
+        # Connection can close cleanly before everything was sent
+        size = os.path.getsize(partpath)
+        if meta["size"] is not None and size < meta["size"]:
+            raise IncompleteDownloadError("Got {} of {} bytes from {}".format(size, meta["size"], url))
+        return meta
+
+    def _verify(self, url, partpath, meta):
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        with open(partpath, "rb") as fobj:
+            for chunk in iter(lambda: fobj.read(downloader.CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                md5.update(chunk)
+
+        size = os.path.getsize(partpath)
+        etag = MD5_ETAG.match(meta.get("etag") or "")
+        if meta["size"] is not None and size != meta["size"]:
+            raise IncompleteDownloadError("Got {} bytes from {}, expected {}".format(size, url, meta["size"]))
+        if etag and etag.group(1) != md5.hexdigest():
+            raise IncompleteDownloadError("Download from {} doesn't match its ETag".format(url))
+        return sha256.hexdigest(), size
+
+    """ USER-FACING METHODS """
+
+    def fetch(self, key, url, revalidate=False):
+        """ fetch: Gets local copy of media, downloading (or resuming) it if it isn't stored yet
+            Args:
+                key: (str) what identifies the media (e.g. video bin url)
+                url: (str) where to download it from
+                revalidate: (boolean) check if media changed since it was stored and download it again if so (optional)
+            Returns: str path to file
+        """
+        with self._get_key_lock(key):
+            path = self.lookup(key)
+            if path and (not revalidate or self._is_current(key, url)):
+                return path
+            if downloader.ARCHIVE is not None:
+                raise downloader.OfflineError("{} was not downloaded by the fetch stage".format(url))
+
+            partpath, metapath = self._get_partial_paths(key)
+            os.makedirs(self.partial_directory, exist_ok=True)
+            with METRICS.timed("download_media"):
+                # A download cut off on the last try keeps its partial file, so the next run resumes it
+                meta = downloader.RETRY.call(url, self._download, partpath, metapath, retryable=_is_retryable_download)
+                try:
+                    digest, size = self._verify(url, partpath, meta)
+                except IncompleteDownloadError:
+                    # Partial file can't be trusted after a failed check, so the next try starts over
+                    os.remove(partpath)
+                    raise
+
+            path = self._store(partpath, digest)
+            os.remove(metapath)
+            self._record({"key": key, "url": url, "sha256": digest, "size": size, "version": meta.get("validator") or digest})
+
+            # Let a snapshot being recorded have the finished file (see benchmarks/replay.py)
+            if downloader.RECORDER is not None:
+                with open(path, "rb") as fobj:
+                    for _ in downloader.RECORDER.record_stream(url, iter(lambda: fobj.read(downloader.CHUNK_SIZE), b"")):
+                        pass
+            return path
@@ -0,0 +1,176 @@
+import contextlib
+import csv
+import functools
+import json
+import threading
+import time
+
+# Counters kept for every (book, page, stage)
+FIELDS = ["calls", "seconds", "self_seconds", "bytes", "hits", "misses", "retries", "errors"]
+
+
+class Metrics():
+    """
+        Timings and counters for each stage of the run, broken down by book and page
+
+        Code being measured runs inside timed(stage). Which book and page it belongs to
+        comes from the innermost scope() on the same thread, so helpers deep in the call
+        stack (downloads, zip writes) don't need to be told. Stages can nest: seconds
+        includes nested stages, self_seconds doesn't, so self_seconds adds up to the
+        time actually spent.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # Current scope and open timers for each thread
+        self.rows = {}                  # Maps (book, page, stage) to counters
+        self.started = time.time()
+
+    def _get_scope(self):
+        return getattr(self.local, "scope", (None, None))
+
+    def _get_timers(self):
+        if not hasattr(self.local, "timers"):
+            self.local.timers = []
+        return self.local.timers
+
+    def _record(self, book, page, stage, counts):
+        with self.lock:
+            row = self.rows.setdefault((book, page, stage), dict.fromkeys(FIELDS, 0))
+            for field, value in counts.items():
+                row[field] += value
+
+    """ USER-FACING METHODS """
+
+    @contextlib.contextmanager
+    def scope(self, book=None, page=None):
+        """ scope: Attributes everything timed on this thread to book and page until the block ends
+            Args:
+                book: (str) book url (optional, keeps the current book if not given)
+                page: (str) page endpoint (optional, None for the book's own pages)
+            Returns: context manager
+        """
+        previous = self._get_scope()
+        self.local.scope = (book or previous[0], page)
+        try:
+            yield
+        finally:
+            self.local.scope = previous
+
+    def bind(self, func):
+        """ bind: Wraps func so it runs in this thread's current scope, wherever it's called from
+            Args: func: (function) function to hand to another thread
+            Returns: function
+        """
+        book, page = self._get_scope()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.scope(book=book, page=page):
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """ timed: Times block as one call to stage (errors raised in the block are counted too)
+            Args: stage: (str) name of stage (e.g. "read_source")
+            Returns: context manager
+        """
+        timers = self._get_timers()
+        counts = {"calls": 1, "nested": 0.0}
+        timers.append(counts)
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            counts["errors"] = counts.get("errors", 0) + 1
+            raise
+        finally:
+            timers.pop()
+            counts["seconds"] = time.time() - start
+            counts["self_seconds"] = counts["seconds"] - counts.pop("nested")
+            if timers:
+                timers[-1]["nested"] += counts["seconds"]
+            book, page = self._get_scope()
+            self._record(book, page, stage, counts)
+
+    def add(self, **counts):
+        """ add: Adds to the counters of the innermost open timer on this thread (ignored if there isn't one)
+            Args: counts: amounts to add (e.g. bytes=1024, hits=1, retries=1)
+            Returns: None
+        """
+        timers = self._get_timers()
+        if timers:
+            for field, value in counts.items():
+                timers[-1][field] = timers[-1].get(field, 0) + value
+
+    def merge(self, rows):
+        """ merge: Adds rows recorded elsewhere (e.g. by a worker process) to this run's
+            Args: rows: ([dict]) rows from another Metrics' get_rows
+            Returns: None
+        """
+        for row in rows:
+            self._record(row["book"] or None, row["page"] or None, row["stage"], {field: row[field] for field in FIELDS})
+
+    def get_rows(self):
+        """ get_rows: Gets counters for each book, page, and stage
+            Args: None
+            Returns: list of dicts sorted by book, page, and stage
+        """
+        with self.lock:
+            rows = [dict(counts, book=book or "", page=page or "", stage=stage) for (book, page, stage), counts in self.rows.items()]
+        return sorted(rows, key=lambda row: (row["book"], row["page"], row["stage"]))
+
+    def get_summary(self, top_n=10):
+        """ get_summary: Totals by stage, plus the books and pages that took the longest
+            Args: top_n: (int) number of slowest books and pages to include (optional)
+            Returns: dict
+        """
+        rows = self.get_rows()
+        stages, books, pages = {}, {}, {}
+        for row in rows:
+            stage = stages.setdefault(row["stage"], dict.fromkeys(FIELDS, 0))
+            for field in FIELDS:
+                stage[field] += row[field]
+            if row["book"]:
+                books[row["book"]] = books.get(row["book"], 0) + row["self_seconds"]
+            if row["page"]:
+                key = (row["book"], row["page"])
+                pages[key] = pages.get(key, 0) + row["self_seconds"]
+
+        slowest_books = sorted(books.items(), key=lambda item: item[1], reverse=True)[:top_n]
+        slowest_pages = sorted(pages.items(), key=lambda item: item[1], reverse=True)[:top_n]
+        return {
+            "wall_seconds": time.time() - self.started,
+            "stages": stages,
+            "slowest_books": [{"book": book, "seconds": seconds} for book, seconds in slowest_books],
+            "slowest_pages": [{"book": book, "page": page, "seconds": seconds} for (book, page), seconds in slowest_pages],
+        }
+
+    def write_report(self, path, top_n=10):
+        """ write_report: Writes summary and rows to <path>.json and rows to <path>.csv
+            Args:
+                path: (str) where to write report, without extension
+                top_n: (int) number of slowest books and pages to include (optional)
+            Returns: dict summary
+        """
+        summary = self.get_summary(top_n=top_n)
+        rows = self.get_rows()
+        with open(path + ".json", "w") as fobj:
+            json.dump(dict(summary, rows=rows), fobj, indent=2)
+        with open(path + ".csv", "w", newline="") as fobj:
+            writer = csv.DictWriter(fobj, fieldnames=["book", "page", "stage"] + FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        return summary
+
+    def reset(self):
+        """ reset: Discards everything recorded so far
+            Args: None
+            Returns: None
+        """
+        with self.lock:
+            self.rows = {}
+            self.started = time.time()
+
+METRICS = Metrics()
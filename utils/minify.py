@@ -0,0 +1,89 @@
+import re
+from bs4.element import NavigableString
+
+SERIALIZATION_MODES = ["prettify", "compact", "minified"]
+
+# Whitespace is significant inside these tags, so minifying leaves them alone
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea", "script", "style"}
+
+# Whitespace around these characters can be dropped from css/js
+# (not ":" in css, since "a :hover" and "a:hover" are different selectors)
+CSS_PUNCTUATION = "{};,>"
+JS_PUNCTUATION = "{}()[];,:?=+-*/<>!&|"
+# Except between these, since "a + +b" and "a - -b" aren't "a++b" and "a--b"
+SIGNS = "+-"
+
+
+def serialize(soup, mode="prettify"):
+    """ serialize: Converts page to html
+        Args:
+            soup: (BeautifulSoup) page to serialize
+            mode: (str) "prettify" (indented), "compact" (as parsed), or "minified" (collapsed whitespace)
+        Returns: str html
+
+        Note: minified mode changes the strings in soup
+    """
+    if mode == "prettify":
+        return soup.prettify()
+    elif mode == "minified":
+        minify_soup(soup)
+    return str(soup)
+
+def minify_soup(soup):
+    """ minify_soup: Collapses runs of whitespace in text, which browsers render the same way
+        Args:
+            soup: (BeautifulSoup) page to minify
+        Returns: None
+    """
+    for string in soup.find_all(text=True):
+        # Skip comments, doctypes, etc. and tags where whitespace matters
+        if type(string) is not NavigableString:
+            continue
+        if any(parent.name in PRESERVE_WHITESPACE_TAGS for parent in string.parents):
+            continue
+        collapsed = re.sub(r"\s+", " ", string)
+        if collapsed != string:
+            string.replace_with(collapsed)
+
+def _minify_code(code, punctuation):
+    """ Collapse whitespace outside of string literals, dropping it next to punctuation """
+    result = []
+    quote = None
+    pending_space = False
+    i = 0
+    while i < len(code):
+        char = code[i]
+        if quote:
+            result.append(char)
+            if char == "\\" and i + 1 < len(code):
+                result.append(code[i + 1])
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char.isspace():
+            pending_space = True
+        else:
+            if pending_space and result and (result[-1] not in punctuation and char not in punctuation or
+                    result[-1] in SIGNS and char in SIGNS):
+                result.append(" ")
+            pending_space = False
+            if char in "'\"":
+                quote = char
+            result.append(char)
+        i += 1
+    return "".join(result)
+
+def minify_css(css):
+    """ minify_css: Removes comments and unneeded whitespace from css
+        Args: css: (str) stylesheet to minify
+        Returns: str minified stylesheet
+    """
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    return _minify_code(css, CSS_PUNCTUATION).replace(";}", "}")
+
+def minify_js(js):
+    """ minify_js: Removes unneeded whitespace from simple scripts (no comments or regex literals)
+        Args: js: (str) script to minify
+        Returns: str minified script
+    """
+    return _minify_code(js, JS_PUNCTUATION)
@@ -0,0 +1,169 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from utils.metrics import METRICS
+
+# Status codes worth trying again (rate limiting and server errors)
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised instead of making a request to a host that keeps failing """
+    pass
+
+
+def is_retryable(error):
+    """ is_retryable: Checks if error is likely to go away if the request is made again
+        Args: error: (Exception) error raised by request
+        Returns: boolean indicating whether or not to retry
+    """
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, TimeoutError))
+
+
+class CircuitBreaker():
+    """
+        Stops sending requests to a host after too many failures in a row
+
+        Once open, requests to the host fail immediately until reset_after seconds
+        have passed, then one request is let through to see if the host recovered.
+    """
+
+    def __init__(self, failure_threshold=5, reset_after=60):
+        """ Args:
+                failure_threshold: (int) failures in a row before host is skipped
+                reset_after: (int) seconds before trying host again
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.failures = {}          # Maps hosts to number of failures in a row
+        self.opened = {}            # Maps hosts to when they started being skipped
+
+    def check(self, host):
+        """ check: Raises CircuitOpenError if host is being skipped
+            Args: host: (str) host about to be requested
+            Returns: None
+        """
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return
+            if time.time() - opened < self.reset_after:
+                raise CircuitOpenError("Skipping {} after {} failures in a row".format(host, self.failures[host]))
+            # Let the next request through, and skip the host again right away if it fails
+            del self.opened[host]
+            self.failures[host] = self.failure_threshold - 1
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def record_failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.failure_threshold:
+                self.opened[host] = time.time()
+
+
+class RetryScheduler():
+    """
+        Retries failed requests with exponential backoff and jitter, with a
+        circuit breaker per host so a dead host doesn't stall every request to it
+    """
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0, breaker=None):
+        """ Args:
+                max_attempts: (int) number of times to try each request
+                base_delay: (float) seconds to wait before the first retry (doubles each retry)
+                max_delay: (float) longest to wait between attempts
+                breaker: (CircuitBreaker) circuit breaker to use (optional)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+
+    def get_delay(self, attempt):
+        """ get_delay: Seconds to wait after attempt failed ("full jitter" backoff)
+            Args: attempt: (int) number of attempts made so far
+            Returns: float seconds
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, path, func, *args, retryable=is_retryable, **kwargs):
+        """ call: Calls func(path, ...), retrying errors that retryable accepts
+            Only request errors (see is_retryable) count against the host's circuit breaker, so a
+            page that loads but is missing what the caller wanted doesn't get its host skipped
+            Args:
+                path: (str) url being requested (used to pick circuit breaker)
+                func: (function) function that makes the request
+                retryable: (function) takes an error and returns whether to retry it (optional)
+            Returns: result of func
+        """
+        host = urlparse(path).netloc
+        attempt = 0
+        while True:
+            attempt += 1
+            if host:
+                self.breaker.check(host)
+            try:
+                result = func(path, *args, **kwargs)
+            except Exception as e:
+                if not retryable(e):
+                    raise
+                if host and is_retryable(e):
+                    self.breaker.record_failure(host)
+                if attempt >= self.max_attempts:
+                    raise
+                METRICS.add(retries=1)
+                time.sleep(self.get_delay(attempt))
+                continue
+            if host:
+                self.breaker.record_success(host)
+            return result
+
+
+class DeferredQueue():
+    """
+        Resources that failed during the run, to be tried again once everything else is done
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}             # Maps owners (e.g. book urls) to resources that failed
+
+    def add(self, owner, resource):
+        """ add: Records resource to try again later
+            Args:
+                owner: (str) what the resource belongs to (e.g. book url)
+                resource: (str) url that failed
+            Returns: None
+        """
+        with self.lock:
+            self.items.setdefault(owner, set()).add(resource)
+
+    def has(self, owner):
+        """ has: Checks if owner has resources waiting to be tried again
+            Args: owner: (str) what the resources belong to
+            Returns: boolean
+        """
+        with self.lock:
+            return bool(self.items.get(owner))
+
+    def pop_all(self):
+        """ pop_all: Removes and returns everything in the queue
+            Args: None
+            Returns: dict mapping owners to sets of resources
+        """
+        with self.lock:
+            items, self.items = self.items, {}
+            return items
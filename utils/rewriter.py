@@ -0,0 +1,61 @@
+from bs4.element import Tag
+
+class DOMRewriter():
+    """
+        Rewrites a parsed page in a single walk of its tree
+
+        Handlers are registered by tag name (and optionally attributes) and get called
+        with each matching element in document order. A handler returns True if it
+        removed or replaced the element, in which case its children aren't visited.
+    """
+
+    def __init__(self):
+        self.handlers = {}          # Maps tag names to lists of (attrs, handler)
+
+    def _matches(self, tag, attrs):
+        for key, value in attrs.items():
+            if key == 'class':
+                if value not in (tag.get('class') or []):
+                    return False
+            elif tag.get(key) != value:
+                return False
+        return True
+
+    def _handle(self, tag):
+        for attrs, handler in self.handlers.get(tag.name, []):
+            if self._matches(tag, attrs):
+                return handler(tag)
+
+    """ USER-FACING METHODS """
+
+    def register(self, name, handler, attrs=None):
+        """ register: Adds handler for elements
+            Args:
+                name: (str) tag name to handle
+                handler: (function) called with each matching tag, returns True if the tag was removed
+                attrs: (dict) attributes tag must have, class matches if it's one of the tag's classes (optional)
+            Returns: None
+
+            Note: only the first matching handler registered for a tag is called
+        """
+        self.handlers.setdefault(name, []).append((attrs or {}, handler))
+
+    def rewrite(self, root):
+        """ rewrite: Visits every element under root once, calling handlers on matches
+            Args:
+                root: (BeautifulSoup or Tag) tree to rewrite
+            Returns: None
+        """
+        stack = [iter(list(root.children))]
+        while stack:
+            tag = next(stack[-1], None)
+            if tag is None:
+                stack.pop()
+                continue
+
+            # Skip text and anything an earlier handler removed from the tree
+            if not isinstance(tag, Tag) or tag.parent is None:
+                continue
+
+            if not self._handle(tag):
+                stack.append(iter(list(tag.children)))
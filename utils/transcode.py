@@ -0,0 +1,91 @@
+import functools
+import os
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.cachedworker import CachedWorker
+
+# Target sizes for transcoded videos (heights are upper bounds, smaller videos keep their size)
+PRESETS = {
+    "360p": {"height": 360, "video_bitrate": "400k", "audio_bitrate": "64k"},
+    "480p": {"height": 480, "video_bitrate": "750k", "audio_bitrate": "96k"},
+    "720p": {"height": 720, "video_bitrate": "1500k", "audio_bitrate": "128k"},
+}
+
+
+def find_ffmpeg():
+    """ find_ffmpeg: Gets path to local ffmpeg
+        Args: None
+        Returns: str path or None if ffmpeg isn't installed
+    """
+    return shutil.which("ffmpeg")
+
+def get_ffmpeg_command(ffmpeg, source_path, output_path, preset):
+    """ get_ffmpeg_command: Builds command to transcode source_path to an h264/aac mp4 for preset
+        Args:
+            ffmpeg: (str) path to ffmpeg
+            source_path: (str) video to transcode
+            output_path: (str) where to write transcoded video
+            preset: (dict) one of PRESETS
+        Returns: list of command arguments
+    """
+    return [
+        ffmpeg, "-nostdin", "-loglevel", "error", "-y", "-i", source_path,
+        "-vf", "scale=-2:'min({},ih)'".format(preset["height"]),   # Keep aspect ratio, never upscale
+        "-c:v", "libx264", "-preset", "medium", "-profile:v", "main", "-pix_fmt", "yuv420p",
+        "-b:v", preset["video_bitrate"], "-maxrate", preset["video_bitrate"], "-bufsize", "2M",
+        "-c:a", "aac", "-b:a", preset["audio_bitrate"], "-ac", "2",
+        "-movflags", "+faststart",                                 # Start playing before the whole file loads
+        "-f", "mp4", output_path,
+    ]
+
+
+class VideoTranscoder(CachedWorker):
+    """
+        Transcodes videos with a local ffmpeg on a bounded pool of workers
+
+        ffmpeg runs in its own processes, so a few threads are enough to keep it busy.
+        Outputs are cached on disk by the hash of the source video and the preset (see
+        CachedWorker), so each video is only transcoded once, and the original is kept
+        if transcoding doesn't make it smaller.
+    """
+
+    def __init__(self, directory, preset, workers=2, ffmpeg=None):
+        """ Args:
+                directory: (str) where to cache transcoded videos
+                preset: (str) name of preset in PRESETS
+                workers: (int) number of videos to transcode at once (optional)
+                ffmpeg: (str) path to ffmpeg (optional, looked up on PATH if not given)
+        """
+        super(VideoTranscoder, self).__init__(directory, preset, workers=workers)
+        self.preset = preset
+        self.ffmpeg = ffmpeg or find_ffmpeg()
+
+    def _create_executor(self):
+        return ThreadPoolExecutor(max_workers=self.workers)
+
+    def _get_job(self, source_path, output_path):
+        return functools.partial(self._transcode, source_path, output_path)
+
+    def _transcode(self, source_path, output_path):
+        size = os.path.getsize(source_path)
+        result = {"path": source_path, "preset": self.preset, "size": size, "transcoded_size": size, "seconds": 0.0}
+        temppath = "{}.{}.tmp.mp4".format(output_path, threading.get_ident())
+        start = time.time()
+        try:
+            subprocess.run(get_ffmpeg_command(self.ffmpeg, source_path, temppath, PRESETS[self.preset]),
+                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            result["seconds"] = time.time() - start
+
+            # Only use the transcoded video if it's actually smaller
+            if os.path.getsize(temppath) < size:
+                os.replace(temppath, output_path + ".mp4")
+                result.update(path=output_path + ".mp4", transcoded_size=os.path.getsize(output_path + ".mp4"))
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError("ffmpeg failed on {}: {}".format(source_path, e.stderr.decode("utf-8", "replace").strip()))
+        finally:
+            if os.path.isfile(temppath):
+                os.remove(temppath)
+        return result
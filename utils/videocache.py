@@ -0,0 +1,110 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Used to keep processes sharing the cache file (e.g. transform workers) from saving at once,
+# not available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class VideoCache():
+    """
+        Persistent map of video iframe urls to resolved video bin urls
+
+        Entries are written to disk as soon as they're recorded, and both resolved
+        and failed lookups expire so they get retried eventually.
+    """
+
+    def __init__(self, path, ttl=90 * 24 * 60 * 60, failure_ttl=24 * 60 * 60):
+        """ Args:
+                path: (str) json file to store cache in
+                ttl: (int) seconds before a resolved video is looked up again (None to never expire)
+                failure_ttl: (int) seconds before a failed video is tried again
+        """
+        self.path = path
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, "r") as fobj:
+            return {src: self._normalize(entry) for src, entry in json.load(fobj).items()}
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", "w") as fobj:
+            fcntl.flock(fobj, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fobj, fcntl.LOCK_UN)
+
+    def _normalize(self, entry):
+        # Older runs stored the video bin url directly
+        if not isinstance(entry, dict):
+            return {"bin": entry, "timestamp": time.time()}
+        return entry
+
+    def _expired(self, entry):
+        ttl = self.ttl if entry["bin"] else self.failure_ttl
+        return ttl is not None and time.time() - entry["timestamp"] > ttl
+
+    def _record(self, src, video_bin):
+        with self.lock:
+            self.entries[src] = {"bin": video_bin, "timestamp": time.time()}
+            self.save()
+
+    """ USER-FACING METHODS """
+
+    def get(self, src):
+        """ get: Looks up video in cache
+            Args:
+                src: (str) url of video iframe
+            Returns: dict with "bin" (video bin url, or None if the video failed to load) or None if not cached
+        """
+        entry = self.entries.get(src)
+        if entry and not self._expired(entry):
+            return entry
+
+    def set(self, src, video_bin):
+        """ set: Records resolved video and writes cache to disk
+            Args:
+                src: (str) url of video iframe
+                video_bin: (str) url of video bin
+            Returns: None
+        """
+        self._record(src, video_bin)
+
+    def set_failed(self, src):
+        """ set_failed: Records that video couldn't be resolved so it's skipped until failure_ttl passes
+            Args:
+                src: (str) url of video iframe
+            Returns: None
+        """
+        self._record(src, None)
+
+    def save(self):
+        """ save: Atomically writes cache to disk, keeping entries other processes saved since it was loaded
+            Args: None
+            Returns: None
+        """
+        with self._file_lock():
+            entries = self._load()
+            for src, entry in self.entries.items():
+                if src not in entries or entries[src]["timestamp"] <= entry["timestamp"]:
+                    entries[src] = entry
+            self.entries = entries
+            temppath = "{}.{}.{}.tmp".format(self.path, os.getpid(), threading.get_ident())
+            with open(temppath, "w") as fobj:
+                json.dump(self.entries, fobj)
+            os.replace(temppath, self.path)
@@ -0,0 +1,273 @@
+""" Bounded on-disk HTTP cache for the downloader
+
+    Usage: python -m utils.webcache stats [--directory .webcache]
+           python -m utils.webcache prune [--directory .webcache] [--html-max-size MB] [--media-max-size MB]
+
+    Both commands also cover the chef's own stores (assets/, media/, optimized/, transcoded/,
+    and the page archive), pruning each to the cap set in sushichef.py.
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+from email.utils import formatdate
+
+from cachecontrol.cache import BaseCache
+from cachecontrol.heuristics import BaseHeuristic
+
+MB = 1024 * 1024
+HTML_MAX_SIZE = 2048 * MB           # Default cap for pages, stylesheets, scripts, etc.
+MEDIA_MAX_SIZE = 4096 * MB          # Default cap for images, video, audio, and documents
+HTML_MAX_AGE = 24 * 60 * 60         # Seconds before cached pages are revalidated with a conditional GET
+MEDIA_MAX_AGE = 10 * 365 * 24 * 60 * 60
+
+MEDIA_EXTENSIONS = {
+    ".mp4", ".webm", ".mp3", ".ogg", ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".svg", ".pdf", ".zip", ".woff", ".woff2", ".ttf", ".bin",
+}
+
+
+def is_media_url(url):
+    """ is_media_url: Checks if url points to binary media based on its extension
+        Args: url: (str) url to check
+        Returns: boolean indicating whether or not url is media
+    """
+    path = url.split("?")[0].split("#")[0]
+    return os.path.splitext(path)[1].lower() in MEDIA_EXTENSIONS
+
+
+class BoundedDirectory():
+    """
+        Files in a directory, capped at max_size bytes
+
+        Files are evicted least recently used first, going by their modification
+        time, so whatever reads a file should mark it as used with touch.
+    """
+
+    def __init__(self, directory, max_size, keep=(), exclude=()):
+        """ Args:
+                directory: (str) directory to cap
+                max_size: (int) max number of bytes to keep (None to never evict anything)
+                keep: (list of str) names of files that are never evicted, e.g. an index (optional)
+                exclude: (list of str) subdirectories to leave out (optional)
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.keep = set(keep)
+        self.exclude = set(exclude)
+        self.size = None            # Total bytes in directory, counted on first write or prune
+
+    def _get_entries(self):
+        entries = []
+        for dirpath, dirs, filenames in os.walk(self.directory):
+            if dirpath == self.directory:
+                dirs[:] = [name for name in dirs if name not in self.exclude]
+            for filename in filenames:
+                if filename in self.keep:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    """ USER-FACING METHODS """
+
+    def touch(self, path):
+        """ touch: Marks file as recently used
+            Args: path: (str) file in directory
+            Returns: None
+        """
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        """ stats: Summarizes what's in the directory
+            Args: None
+            Returns: dict with number of files, total bytes, cap, and the oldest and newest use times
+        """
+        entries = self._get_entries()
+        return {
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+            'max_size': self.max_size,
+            'oldest': min(mtime for mtime, _, _ in entries) if entries else None,
+            'newest': max(mtime for mtime, _, _ in entries) if entries else None,
+        }
+
+    def prune(self, max_size=None, since=None):
+        """ prune: Evicts least recently used files until directory fits in max_size
+            Args:
+                max_size: (int) number of bytes to shrink directory to (optional, defaults to cap)
+                since: (float) timestamp after which files count as in use and are kept (optional)
+            Returns: number of bytes evicted
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = sorted(self._get_entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for mtime, size, path in entries:
+            if max_size is None or total - evicted <= max_size or (since is not None and mtime >= since):
+                break
+            if (".tmp" in path or path.endswith(".part")) and mtime > time.time() - 60 * 60:
+                continue # Skip files that are still being written
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            evicted += size
+        self.size = total - evicted
+        return evicted
+
+
+class BoundedFileCache(BoundedDirectory, BaseCache):
+    """
+        CacheControl cache stored in a directory, capped at max_size bytes
+
+        Reading an entry marks it as recently used, and the least recently used
+        entries are evicted once the cache grows past its cap.
+    """
+
+    def __init__(self, directory, max_size):
+        """ Args:
+                directory: (str) where to store cached responses
+                max_size: (int) max number of bytes to keep
+        """
+        super(BoundedFileCache, self).__init__(directory, max_size)
+        self.lock = threading.Lock()
+
+    def _get_path(self, key):
+        digest = hashlib.sha224(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return 0
+        if self.size is not None:
+            self.size -= size
+        return size
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as fobj:
+                value = fobj.read()
+        except (IOError, OSError):
+            return None
+        self.touch(path)
+        return value
+
+    def set(self, key, value, expires=None):
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temppath = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temppath, "wb") as fobj:
+            fobj.write(value)
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._get_entries()) - len(value)
+            self._remove(path)
+            os.replace(temppath, path)
+            self.size += len(value)
+            if self.size > self.max_size:
+                # Evict down to 90% of the cap so we don't have to scan the cache on every write
+                self.prune(int(self.max_size * 0.9))
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(self._get_path(key))
+
+
+class TieredCache(BaseCache):
+    """
+        Keeps pages and binary media in separate caches so large media can't
+        push small, frequently revalidated pages out of the cache
+    """
+
+    def __init__(self, directory, html_max_size=HTML_MAX_SIZE, media_max_size=MEDIA_MAX_SIZE):
+        """ Args:
+                directory: (str) where to store cached responses
+                html_max_size: (int) max bytes of pages to keep (optional)
+                media_max_size: (int) max bytes of media to keep (optional)
+        """
+        self.html = BoundedFileCache(os.path.join(directory, "html"), html_max_size)
+        self.media = BoundedFileCache(os.path.join(directory, "media"), media_max_size)
+
+        # Entries from the old unbounded FileCache (.webcache/a/b/c/d/e/<hash>) can't be read by
+        # either tier, since they don't say which tier their url belongs in, so they're only pruned
+        # (by hand, with the prune command below; runs leave them alone)
+        self.legacy = BoundedDirectory(directory, 0, exclude=["html", "media"])
+
+    def _get_cache(self, key):
+        return self.media if is_media_url(key) else self.html
+
+    def get(self, key):
+        return self._get_cache(key).get(key)
+
+    def set(self, key, value, expires=None):
+        self._get_cache(key).set(key, value)
+
+    def delete(self, key):
+        self._get_cache(key).delete(key)
+
+
+class RevalidatingHeuristic(BaseHeuristic):
+    """
+        Caches pages for html_max_age and media for media_max_age, whatever the server says
+
+        Once a page is older than html_max_age, CacheControl revalidates it with a
+        conditional GET (If-None-Match/If-Modified-Since) instead of downloading it again.
+    """
+
+    def __init__(self, html_max_age=HTML_MAX_AGE, media_max_age=MEDIA_MAX_AGE):
+        self.html_max_age = html_max_age
+        self.media_max_age = media_max_age
+
+    def update_headers(self, response):
+        content_type = response.headers.get('content-type') or ""
+        media = not content_type.startswith("text/") and "javascript" not in content_type and "json" not in content_type
+        max_age = self.media_max_age if media else self.html_max_age
+        return {
+            'cache-control': 'public, max-age={}'.format(max_age),
+            'expires': formatdate(time.time() + max_age, usegmt=True),
+        }
+
+    def warning(self, response):
+        return None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Inspect and prune the downloader's http cache")
+    arg_parser.add_argument('command', choices=['stats', 'prune'])
+    arg_parser.add_argument('--directory', default='.webcache', help='cache directory')
+    arg_parser.add_argument('--html-max-size', type=int, default=HTML_MAX_SIZE // MB, help='MB of pages to keep when pruning')
+    arg_parser.add_argument('--media-max-size', type=int, default=MEDIA_MAX_SIZE // MB, help='MB of media to keep when pruning')
+    args = arg_parser.parse_args()
+
+    cache = TieredCache(args.directory, html_max_size=args.html_max_size * MB, media_max_size=args.media_max_size * MB)
+    tiers = [("html", cache.html), ("media", cache.media), ("legacy", cache.legacy)]
+
+    # The chef's stores are listed by the chef, which doesn't create anything when imported
+    import sushichef
+    tiers.extend(sushichef.get_stores())
+
+    for name, tier in tiers:
+        if args.command == 'prune':
+            print("{}: evicted {:.1f} MB".format(name, tier.prune() / MB))
+        stats = tier.stats()
+        print("{}: {} entries, {:.1f} MB of {}{}".format(
+            name, stats['entries'], stats['size'] / MB,
+            "{:.1f} MB".format(stats['max_size'] / MB) if stats['max_size'] is not None else "unlimited",
+            ", last used {}".format(time.ctime(stats['newest'])) if stats['newest'] else ""))
+
+
+if __name__ == '__main__':
+    main()